@@ -0,0 +1,143 @@
+import argparse
+import datetime
+import gc
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+import storage
+from blockchain import Blockchain, Block
+from benchmarks.synthetic import make_chain
+
+
+class LegacyTransaction:
+    # A transaction as it was decoded before __slots__ and interning: every
+    # instance has its own __dict__ and its own copy of each string
+    def __init__(self, sender, recipient, amount, fee=0, nonce=0, public_key='', signature=''):
+        self.sender = sender
+        self.recipient = recipient
+        self.amount = amount
+        self.fee = fee
+        self.nonce = nonce
+        self.public_key = public_key
+        self.signature = signature
+
+
+class LegacyBlock:
+    def __init__(self, index, timestamp, transactions, previous_hash, nonce, hash, version):
+        self.version = version
+        self.index = index
+        self.timestamp = timestamp
+        self._transactions = tuple(transactions)
+        self._payload = None
+        self._merkle_root = None
+        self.previous_hash = previous_hash
+        self.nonce = nonce
+        self.hash = hash
+
+
+def decode_legacy_row(row):
+    transactions = [LegacyTransaction(tx['sender'], tx['recipient'], tx['amount'], tx.get('fee', 0), tx.get('nonce', 0),
+                                      tx.get('public_key', ''), tx.get('signature', '')) for tx in json.loads(row[2])]
+    return LegacyBlock(row[0], datetime.datetime.fromisoformat(row[1]), transactions, row[3], row[4], row[5], row[6])
+
+
+def build_database(db_path, chain):
+    blockchain = Blockchain(db_path=db_path)
+    with blockchain.conn:
+        blockchain.store_blocks(chain[1:])
+    blockchain.conn.close()
+
+
+def build_legacy_database(db_path, chain):
+    # The row format before transactions were stored as lists: one JSON dict
+    # per transaction
+    conn = sqlite3.connect(db_path)
+    conn.execute('''CREATE TABLE blocks (
+                        block_index INTEGER PRIMARY KEY,
+                        timestamp TEXT,
+                        transactions TEXT,
+                        previous_hash TEXT,
+                        nonce INTEGER,
+                        hash TEXT,
+                        version INTEGER
+                    )''')
+    with conn:
+        conn.executemany('INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         [(block.index, block.timestamp.isoformat(), json.dumps([tx.to_dict() for tx in block.transactions]),
+                           block.previous_hash, block.nonce, block.hash, block.version) for block in chain[1:]])
+    conn.close()
+
+
+def measure(load):
+    # Decodes every stored block and keeps them alive, as a full in-memory
+    # chain would, measuring what the decoded objects hold. Timed without
+    # tracing, which slows every allocation down.
+    started = time.perf_counter()
+    blocks = load()
+    elapsed = time.perf_counter() - started
+    del blocks
+    gc.collect()
+    tracemalloc.start()
+    blocks = load()
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    transactions = sum(len(block._transactions) for block in blocks)
+    return held, elapsed, len(blocks), transactions
+
+
+def load_all(db_path):
+    conn = storage.connect(db_path)
+    view = storage.ChainView(conn, Block.from_row)
+    try:
+        return measure(lambda: list(view.iter_from(1)))
+    finally:
+        conn.close()
+
+
+def load_legacy(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return measure(lambda: [decode_legacy_row(row) for row in conn.execute('SELECT * FROM blocks ORDER BY block_index')])
+    finally:
+        conn.close()
+
+
+def summarize(held, elapsed, blocks, transactions):
+    return {
+        'bytes_per_transaction': round(held / transactions, 1),
+        'bytes_per_block': round(held / blocks, 1),
+        'decoded_blocks_per_sec': round(blocks / elapsed, 1)
+    }
+
+
+def run(height, txs_per_block):
+    chain = make_chain(height, txs_per_block)
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'memory.db')
+        legacy_path = os.path.join(directory, 'legacy.db')
+        build_database(db_path, chain)
+        build_legacy_database(legacy_path, chain)
+        del chain
+        gc.collect()
+        before = summarize(*load_legacy(legacy_path))
+        after = summarize(*load_all(db_path))
+    return {
+        'height': height,
+        'txs_per_block': txs_per_block,
+        'before': before,
+        'after': after,
+        'memory_ratio': round(before['bytes_per_transaction'] / after['bytes_per_transaction'], 2)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mide la memoria que ocupan los bloques y transacciones decodificados, con el formato anterior y el actual")
+    parser.add_argument('--height', type=int, default=2000)
+    parser.add_argument('--txs-per-block', type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps(run(args.height, args.txs_per_block), indent=2))
@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import storage
+from blockchain import Blockchain
+from benchmarks.synthetic import make_chain
+
+
+def import_legacy(db_path, chain):
+    # The storage path before WAL and bulk inserts: rollback journal, no index
+    # on hash, one SELECT and one commit per block
+    conn = sqlite3.connect(db_path)
+    conn.execute('''CREATE TABLE blocks (
+                        block_index INTEGER PRIMARY KEY,
+                        timestamp TEXT,
+                        transactions TEXT,
+                        previous_hash TEXT,
+                        nonce INTEGER,
+                        hash TEXT
+                    )''')
+    started = time.perf_counter()
+    for block in chain:
+        with conn:
+            if conn.execute('SELECT * FROM blocks WHERE hash = ?', (block.hash,)).fetchone() is None:
+                conn.execute('INSERT INTO blocks (block_index, timestamp, transactions, previous_hash, nonce, hash) VALUES (?, ?, ?, ?, ?, ?)',
+                             (block.index, block.timestamp.isoformat(), json.dumps([tx.to_dict() for tx in block.transactions]),
+                              block.previous_hash, block.nonce, block.hash))
+    elapsed = time.perf_counter() - started
+    conn.close()
+    return elapsed
+
+
+def import_batched(db_path, chain, synchronous):
+    blockchain = Blockchain(db_path=db_path, synchronous=synchronous)
+    started = time.perf_counter()
+    with blockchain.conn:
+        blockchain.store_blocks(chain[1:])
+    elapsed = time.perf_counter() - started
+    blockchain.conn.close()
+    return elapsed
+
+
+def run(height, txs_per_block, synchronous):
+    chain = make_chain(height, txs_per_block)
+    results = {'height': height, 'txs_per_block': txs_per_block, 'synchronous': synchronous}
+    with tempfile.TemporaryDirectory() as directory:
+        legacy = import_legacy(os.path.join(directory, 'legacy.db'), chain)
+        # The batched import also maintains the balances and undo tables
+        batched = import_batched(os.path.join(directory, 'batched.db'), chain, synchronous)
+    results['legacy_blocks_per_sec'] = round(len(chain) / legacy, 1)
+    results['batched_blocks_per_sec'] = round(height / batched, 1)
+    results['speedup'] = round((height / batched) / (len(chain) / legacy), 2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compara la importación de cadenas antes y después del almacenamiento por lotes")
+    parser.add_argument('--height', type=int, default=5000)
+    parser.add_argument('--txs-per-block', type=int, default=5)
+    parser.add_argument('--synchronous', choices=storage.SYNCHRONOUS_MODES, default='NORMAL')
+    args = parser.parse_args()
+    print(json.dumps(run(args.height, args.txs_per_block, args.synchronous), indent=2))
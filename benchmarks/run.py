@@ -0,0 +1,166 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+
+import mining
+import signatures
+from blockchain import Blockchain, Block, Transaction
+from benchmarks.synthetic import make_chain
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def bench_mining(difficulty, blocks, workers):
+    # Raw nonce search rate with a target no hash can meet, then whole blocks
+    # mined at the requested difficulty
+    block = Block(1, datetime.datetime(2024, 1, 1), [Transaction('5001', '5002', 1.0)], '0' * 64, target=1)
+    attempts = 200000
+    _, elapsed = timed(mining.search_nonces, block.mining_prefix(), 1, 0, attempts, block.nonce_encoder())
+    results = {'hashes_per_sec': round(attempts / elapsed, 1), 'difficulty': difficulty, 'workers': workers}
+
+    target = mining.difficulty_limit(difficulty)
+    started = time.perf_counter()
+    for index in range(blocks):
+        Block(index + 1, datetime.datetime.now(), [Transaction('5001', '5002', float(index))], '0' * 64, target=target).mine_block(workers)
+    results['mined_blocks_per_sec'] = round(blocks / (time.perf_counter() - started), 3)
+    return results
+
+
+def bench_chain(directory, height, txs_per_block):
+    chain = make_chain(height, txs_per_block, signed=True)
+    results = {}
+
+    db_path = os.path.join(directory, 'chain.db')
+    blockchain = Blockchain(db_path=db_path)
+    _, elapsed = timed(blockchain.store_blocks, chain[1:])
+    blockchain.conn.commit()
+    results['store_blocks_per_sec'] = round(height / elapsed, 1)
+    blockchain.conn.close()
+
+    single = Blockchain(db_path=os.path.join(directory, 'single.db'))
+    started = time.perf_counter()
+    for block in chain[1:]:
+        single.add_block_to_db(block)
+    results['add_block_to_db_per_sec'] = round(height / (time.perf_counter() - started), 1)
+    single.conn.close()
+
+    # Startup reads the stored balances; a rebuild replays every block
+    blockchain, elapsed = timed(Blockchain, 4, db_path)
+    results['startup_seconds'] = round(elapsed, 4)
+    _, elapsed = timed(blockchain.rebuild_balances)
+    results['rebuild_balances_seconds'] = round(elapsed, 4)
+
+    # Each pass decodes the blocks again so nothing they hash is cached yet
+    blocks = list(blockchain.chain.iter_from(1))
+    _, elapsed = timed(lambda: [block.calculate_hash() for block in blocks])
+    results['calculate_hash_per_sec'] = round(len(blocks) / elapsed, 1)
+    blocks = list(blockchain.chain.iter_from(1))
+    workers = blockchain.validation_workers
+    blockchain.validation_workers = 1
+    valid, elapsed = timed(blockchain.validate_blocks, chain[0], blocks)
+    results['validated_blocks_per_sec_serial'] = round(height / elapsed, 1)
+    blockchain.validation_workers = workers
+    blocks = list(blockchain.chain.iter_from(1))
+    valid_parallel, elapsed = timed(blockchain.validate_blocks, chain[0], blocks)
+    results['validated_blocks_per_sec'] = round(height / elapsed, 1)
+    results['validation_workers'] = workers
+    valid_signatures, elapsed = timed(blockchain.check_transactions, blocks)
+    results['signature_checked_blocks_per_sec'] = round(height / elapsed, 1)
+    results['valid'] = valid and valid_parallel and valid_signatures
+    blockchain.shutdown_workers()
+    blockchain.conn.close()
+    return results
+
+
+def bench_gossip(directory, node_count, transaction_count, base_port):
+    # A full mesh of local nodes; transactions enter at the first node and are
+    # counted once every node holds all of them in its mempool
+    from p2p import Node
+
+    key = signatures.generate_key()
+    sender = signatures.address(signatures.public_key_hex(key))
+    nodes = [
+        Node('127.0.0.1', base_port + i, db_path=os.path.join(directory, f'nodo_{i}.db'), key_path=os.path.join(directory, f'nodo_{i}.key'),
+             genesis_accounts=[sender])
+        for i in range(node_count)
+    ]
+    startup = []
+    for node in nodes:
+        started = time.perf_counter()
+        threading.Thread(target=node.start, daemon=True).start()
+        node.started.wait()
+        startup.append(time.perf_counter() - started)
+    for node in nodes:
+        for other in nodes:
+            if other is not node:
+                node.connect_to_peer(other.host, other.port)
+
+    transactions = []
+    for nonce in range(transaction_count):
+        transaction = Transaction(sender, nodes[-1].node_id, 0.001, 0, nonce)
+        transaction.sign(key)
+        transactions.append(transaction)
+
+    started = time.perf_counter()
+    for transaction in transactions:
+        nodes[0].on_chain(nodes[0].blockchain.accept_transaction, transaction)
+        nodes[0].broadcast_transaction(transaction)
+    deadline = started + 120
+    while time.perf_counter() < deadline and any(len(node.blockchain.mempool) < transaction_count for node in nodes):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    delivered = min(len(node.blockchain.mempool) for node in nodes)
+
+    for node in nodes:
+        node.stop()
+    time.sleep(0.5)
+    return {
+        'nodes': node_count,
+        'transactions': transaction_count,
+        'delivered_to_all': delivered,
+        'transactions_per_sec': round(delivered / elapsed, 1),
+        'node_startup_seconds': round(max(startup), 4)
+    }
+
+
+def run(args):
+    results = {'config': vars(args)}
+    # Nodes and the chain report every transaction and block; only the JSON goes out
+    with contextlib.redirect_stdout(io.StringIO()), tempfile.TemporaryDirectory() as directory:
+        results['mining'] = bench_mining(args.difficulty, args.mined_blocks, args.mining_workers)
+        results['chain'] = bench_chain(directory, args.height, args.txs_per_block)
+        if args.nodes > 1:
+            results['gossip'] = bench_gossip(directory, args.nodes, args.transactions, args.base_port)
+    # ru_maxrss is in kilobytes on Linux
+    results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mide minado, hashing, validación, almacenamiento y difusión de mensajes")
+    parser.add_argument('--height', type=int, default=1000)
+    parser.add_argument('--txs-per-block', type=int, default=20)
+    parser.add_argument('--difficulty', type=int, default=4)
+    parser.add_argument('--mined-blocks', type=int, default=5)
+    parser.add_argument('--mining-workers', type=int, default=1)
+    parser.add_argument('--nodes', type=int, default=3, help="0 o 1 para omitir la prueba de red")
+    parser.add_argument('--transactions', type=int, default=1000)
+    parser.add_argument('--base-port', type=int, default=7100)
+    parser.add_argument('--output', help="archivo donde guardar el JSON además de imprimirlo")
+    args = parser.parse_args()
+    report = json.dumps(run(args), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
@@ -0,0 +1,422 @@
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from blockchain import Blockchain, Transaction
+from p2p import Node
+from benchmarks.synthetic import make_accounts
+
+# Accounts funded by the genesis block send every transaction
+SENDERS = 4
+HOST = '127.0.0.1'
+
+
+class SimNode(Node):
+    # A node that notes when transactions reach its mempool and blocks become
+    # its tip, and whose frames reach each peer `latency` seconds (plus up to
+    # `jitter`) after they are sent, still in order
+    def __init__(self, host, port, transaction_times, tip_times, latency=0, jitter=0, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.transaction_times = transaction_times
+        self.tip_times = tip_times
+        self.latency = latency
+        self.jitter = jitter
+        self.deliveries = {}
+
+    async def enqueue(self, address, frame):
+        if not self.latency and not self.jitter:
+            return await Node.enqueue(self, address, frame)
+        at = max(self.loop.time() + self.latency + random.uniform(0, self.jitter), self.deliveries.get(address, 0))
+        self.deliveries[address] = at
+        self.loop.call_at(at, lambda: asyncio.ensure_future(Node.enqueue(self, address, frame)))
+        return True
+
+    def handle_transactions(self, transactions):
+        accepted = super().handle_transactions(transactions)
+        now = time.time()
+        for transaction in accepted:
+            self.transaction_times.setdefault(transaction.hash(), now)
+        return accepted
+
+    def notify(self, *kinds):
+        if 'chain' in kinds or 'started' in kinds:
+            self.tip_times.setdefault(self.blockchain.published.tip_hash, time.time())
+        super().notify(*kinds)
+
+
+class NodeRunner:
+    # Starts, restarts and stops one simulated node and keeps what it saw
+    # across restarts. Called directly when all nodes share the process, or by
+    # serve_runner in the node's own process. Times are wall clock, so those
+    # taken in different processes can be compared.
+    def __init__(self, port, db_path, key_path, latency=0, jitter=0, mining_workers=1, own_process=False):
+        self.port = port
+        self.db_path = db_path
+        self.key_path = key_path
+        self.latency = latency
+        self.jitter = jitter
+        self.mining_workers = mining_workers
+        self.own_process = own_process
+        self.node = None
+        self.thread = None
+        self.transaction_times = {}
+        self.tip_times = {}
+        self.mined = []
+        self.restarts = 0
+
+    def start(self):
+        node = SimNode(HOST, self.port, self.transaction_times, self.tip_times, self.latency, self.jitter,
+                       db_path=self.db_path, mining_workers=self.mining_workers, key_path=self.key_path)
+        self.thread = threading.Thread(target=node.start, daemon=True)
+        self.thread.start()
+        node.started.wait()
+        self.node = node
+
+    def connect(self, ports):
+        for port in ports:
+            self.node.connect_to_peer(HOST, port)
+
+    def submit(self, transaction):
+        # Enters the mempool of this node and is gossiped from there
+        transaction = Transaction.from_dict(transaction)
+        self.transaction_times.setdefault(transaction.hash(), time.time())
+        node = self.node
+
+        def submit():
+            if node.blockchain.accept_transaction(transaction):
+                node.notify('mempool')
+                node.broadcast_transaction(transaction)
+        node.chain_executor.submit(submit)
+
+    def mine(self):
+        def mined(future):
+            if not future.exception() and future.result():
+                self.mined.append((future.result().hash, time.time()))
+        self.node.mining_executor.submit(self.node.mine).add_done_callback(mined)
+
+    def restart(self, downtime, ports):
+        threading.Thread(target=self.cycle, args=(downtime, ports), daemon=True).start()
+
+    def cycle(self, downtime, ports):
+        node, self.node = self.node, None
+        self.stop_node(node)
+        time.sleep(downtime)
+        self.start()
+        self.connect(ports)
+        self.restarts += 1
+
+    def stop_node(self, node):
+        node.stop()
+        self.thread.join(10)
+        node.mining_executor.shutdown(wait=False, cancel_futures=True)
+        node.chain_executor.shutdown(wait=False)
+
+    def status(self):
+        # None while the node is restarting
+        node = self.node
+        if node is None:
+            return None
+
+        def read():
+            published = node.blockchain.published
+            return {'height': published.height, 'tip': published.tip_hash, 'mempool': list(node.blockchain.mempool.entries)}
+        return node.chain_executor.submit(read).result()
+
+    def main_chain(self):
+        node = self.node
+        return node.chain_executor.submit(lambda: [block.hash for block in node.blockchain.chain.iter_from(1)]).result()
+
+    def report(self):
+        report = {
+            'transactions': self.transaction_times,
+            'tips': self.tip_times,
+            'mined': self.mined,
+            'restarts': self.restarts,
+            'cpu_seconds': None,
+            'peak_rss_kb': None
+        }
+        if self.own_process:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            report['cpu_seconds'] = round(usage.ru_utime + usage.ru_stime, 3)
+            report['peak_rss_kb'] = usage.ru_maxrss
+        return report
+
+    def stop(self):
+        if self.node is not None:
+            self.stop_node(self.node)
+            self.node = None
+
+
+def serve_runner(conn, *args):
+    # Runs a NodeRunner in a process of its own, answering the calls sent over `conn`
+    sys.stdout = open(os.devnull, 'w')
+    runner = NodeRunner(*args, own_process=True)
+    while True:
+        name, call_args = conn.recv()
+        try:
+            conn.send((True, getattr(runner, name)(*call_args)))
+        except Exception as e:
+            conn.send((False, f'{type(e).__name__}: {e}'))
+        if name == 'stop':
+            return
+
+
+class ProcessRunner:
+    # Same calls as NodeRunner, forwarded to a runner in another process
+    def __init__(self, context, *args):
+        self.conn, child = context.Pipe()
+        # Not a daemon: a node may start a process pool to validate blocks
+        self.process = context.Process(target=serve_runner, args=(child,) + args)
+        self.process.start()
+
+    def call(self, name, *args):
+        self.conn.send((name, args))
+        ok, result = self.conn.recv()
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def __getattr__(self, name):
+        return lambda *args: self.call(name, *args)
+
+    def stop(self):
+        try:
+            self.call('stop')
+        finally:
+            self.process.join(15)
+            if self.process.is_alive():
+                self.process.terminate()
+
+
+def percentiles(seconds):
+    # In milliseconds
+    if not seconds:
+        return None
+    seconds = sorted(seconds)
+    pick = lambda q: round(seconds[min(len(seconds) - 1, int(q * len(seconds)))] * 1000, 1)
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': round(seconds[-1] * 1000, 1), 'samples': len(seconds)}
+
+
+def start_cluster(directory, args, rng):
+    # Every node starts from a copy of the same genesis block, then connects
+    # to `args.peers` others picked at random
+    accounts, keys = make_accounts(SENDERS, signed=True)
+    template = os.path.join(directory, 'genesis.db')
+    blockchain = Blockchain(args.difficulty, template, genesis_accounts=accounts)
+    blockchain.conn.close()
+    context = multiprocessing.get_context('spawn')
+    runners = []
+    for i in range(args.nodes):
+        db_path = os.path.join(directory, f'nodo_{i}.db')
+        shutil.copy(template, db_path)
+        runner_args = (args.base_port + i, db_path, os.path.join(directory, f'nodo_{i}.key'),
+                       args.latency_ms / 1000, args.jitter_ms / 1000, args.mining_workers)
+        runners.append(ProcessRunner(context, *runner_args) if args.processes else NodeRunner(*runner_args))
+    for runner in runners:
+        runner.start()
+    ports = [args.base_port + i for i in range(args.nodes)]
+    peers = [rng.sample(ports[:i] + ports[i + 1:], min(args.peers, args.nodes - 1)) for i in range(args.nodes)]
+    for runner, peer_ports in zip(runners, peers):
+        runner.connect(peer_ports)
+    return runners, peers, keys
+
+
+def drive(runners, peers, keys, args, rng):
+    # Sends transactions and mining requests at random times (Poisson
+    # arrivals) to nodes that are up, restarts one every churn interval and
+    # samples how far apart the mempools are every second
+    accounts = list(keys)
+    nonces = dict.fromkeys(accounts, 0)
+    submitted = {}
+    down_until = [0] * len(runners)
+    divergence = []
+    restarts = 0
+
+    started = time.time()
+    end = started + args.duration
+    next_transaction = started + rng.expovariate(args.tx_rate) if args.tx_rate > 0 else math.inf
+    next_block = started + rng.expovariate(1 / args.block_interval) if args.block_interval > 0 else math.inf
+    next_churn = started + args.churn_interval if args.churn_interval > 0 else math.inf
+    next_sample = started + 1
+    while True:
+        due = min(next_transaction, next_block, next_churn, next_sample)
+        if due >= end:
+            break
+        now = time.time()
+        if due > now:
+            time.sleep(due - now)
+            continue
+        live = [i for i, until in enumerate(down_until) if until <= now]
+        if not live:
+            pass
+        elif due == next_transaction:
+            account = accounts[len(submitted) % len(accounts)]
+            transaction = Transaction(account, 'simulacion', 0.001, 0, nonces[account])
+            transaction.sign(keys[account])
+            nonces[account] += 1
+            origin = rng.choice(live)
+            runners[origin].submit(transaction.to_dict())
+            submitted[transaction.hash()] = origin
+        elif due == next_block:
+            runners[rng.choice(live)].mine()
+        elif due == next_churn:
+            restarted = rng.choice(live)
+            runners[restarted].restart(args.churn_downtime, peers[restarted])
+            # Counted as down until it has had time to start again
+            down_until[restarted] = now + args.churn_downtime + 1
+            restarts += 1
+        else:
+            mempools = [set(status['mempool']) for status in (runners[i].status() for i in live) if status is not None]
+            union = set().union(*mempools)
+            if union:
+                divergence.append(1 - len(set.intersection(*mempools)) / len(union))
+        if due == next_transaction:
+            next_transaction += rng.expovariate(args.tx_rate)
+        elif due == next_block:
+            next_block += rng.expovariate(1 / args.block_interval)
+        elif due == next_churn:
+            next_churn += args.churn_interval
+        else:
+            next_sample += 1
+    elapsed = time.time() - started
+
+    # With the load stopped, wait for every node to agree on the tip and on
+    # the mempool contents
+    settle_started = time.time()
+    tips_agree_after = mempools_agree_after = None
+    while time.time() - settle_started < args.settle:
+        statuses = [runner.status() for runner in runners]
+        if None not in statuses:
+            waited = round(time.time() - settle_started, 3)
+            if tips_agree_after is None and len({status['tip'] for status in statuses}) == 1:
+                tips_agree_after = waited
+            if mempools_agree_after is None and len({frozenset(status['mempool']) for status in statuses}) == 1:
+                mempools_agree_after = waited
+            if tips_agree_after is not None and mempools_agree_after is not None:
+                break
+        time.sleep(0.25)
+    statuses = [runner.status() or {'height': None, 'tip': None, 'mempool': []} for runner in runners]
+    return submitted, restarts, divergence, elapsed, statuses, tips_agree_after, mempools_agree_after
+
+
+def summarize(runners, args, submitted, restarts, divergence, elapsed, statuses, tips_agree_after, mempools_agree_after):
+    reports = [runner.report() for runner in runners]
+    # A transaction's delay is counted from the node it entered at to each of
+    # the others; a block's, from the node that mined it to each node where it
+    # became the tip
+    transaction_delays = []
+    delivered_to_all = 0
+    for txid, origin in submitted.items():
+        sent = reports[origin]['transactions'].get(txid)
+        arrivals = [report['transactions'].get(txid) for i, report in enumerate(reports) if i != origin]
+        if sent is None:
+            continue
+        transaction_delays.extend(arrival - sent for arrival in arrivals if arrival is not None)
+        if None not in arrivals:
+            delivered_to_all += 1
+
+    main_chain = set(runners[0].main_chain())
+    block_delays = []
+    mined = stale = 0
+    for miner, report in enumerate(reports):
+        for block_hash, sent in report['mined']:
+            mined += 1
+            if block_hash not in main_chain:
+                stale += 1
+            for i, other in enumerate(reports):
+                if i != miner and block_hash in other['tips']:
+                    block_delays.append(other['tips'][block_hash] - sent)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'seconds': round(elapsed, 3),
+        'transactions': {
+            'submitted': len(submitted),
+            'per_sec': round(len(submitted) / elapsed, 1),
+            'delivered_to_all': delivered_to_all,
+            'propagation_ms': percentiles(transaction_delays)
+        },
+        'blocks': {
+            'mined': mined,
+            'stale': stale,
+            'fork_rate': round(stale / mined, 4) if mined else None,
+            'propagation_ms': percentiles(block_delays)
+        },
+        'convergence': {
+            'mempool_divergence_mean': round(sum(divergence) / len(divergence), 4) if divergence else None,
+            'mempool_divergence_max': round(max(divergence), 4) if divergence else None,
+            'tips_agree_after_seconds': tips_agree_after,
+            'mempools_agree_after_seconds': mempools_agree_after
+        },
+        'restarts': restarts,
+        'nodes': [
+            {
+                'port': args.base_port + i,
+                'height': status['height'],
+                'mempool': len(status['mempool']),
+                'restarts': report['restarts'],
+                'cpu_seconds': report['cpu_seconds'],
+                'peak_rss_kb': report['peak_rss_kb']
+            }
+            for i, (status, report) in enumerate(zip(statuses, reports))
+        ],
+        # With --processes this is only the driver; otherwise it holds every node
+        'process': {'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3), 'peak_rss_kb': usage.ru_maxrss}
+    }
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    results = {'config': vars(args)}
+    # Nodes report every transaction and block; only the JSON goes out
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            runners, peers, keys = start_cluster(directory, args, rng)
+            try:
+                measured = drive(runners, peers, keys, args, rng)
+                results.update(summarize(runners, args, *measured))
+            finally:
+                for runner in runners:
+                    runner.stop()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simula una red local de nodos bajo carga y mide la propagación, las bifurcaciones y los recursos usados")
+    parser.add_argument('--nodes', type=int, default=5)
+    parser.add_argument('--peers', type=int, default=2, help="peers a los que se conecta cada nodo al arrancar")
+    parser.add_argument('--duration', type=float, default=30, help="segundos de carga")
+    parser.add_argument('--tx-rate', type=float, default=20, help="transacciones por segundo")
+    parser.add_argument('--block-interval', type=float, default=5, help="segundos promedio entre bloques, 0 para no minar")
+    parser.add_argument('--difficulty', type=int, default=3, help="dificultad del bloque génesis")
+    parser.add_argument('--mining-workers', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=0, help="retardo de cada mensaje entre nodos")
+    parser.add_argument('--jitter-ms', type=float, default=0, help="retardo aleatorio adicional, hasta este valor")
+    parser.add_argument('--churn-interval', type=float, default=0, help="segundos entre reinicios de nodos, 0 para no reiniciar")
+    parser.add_argument('--churn-downtime', type=float, default=3, help="segundos que un nodo reiniciado permanece apagado")
+    parser.add_argument('--settle', type=float, default=30, help="segundos máximos de espera para que los nodos coincidan")
+    parser.add_argument('--processes', action='store_true', help="un proceso por nodo, para medir CPU y memoria de cada uno")
+    parser.add_argument('--base-port', type=int, default=7600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="archivo donde guardar el JSON además de imprimirlo")
+    args = parser.parse_args()
+    report = json.dumps(run(args), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
@@ -0,0 +1,41 @@
+import datetime
+import random
+
+import signatures
+from blockchain import Block, Transaction, MAX_TARGET, TARGET_BLOCK_SECONDS
+
+
+def make_accounts(count, signed=False):
+    # Signed chains need accounts named after their keys; returns the
+    # accounts and the key of each
+    if not signed:
+        return [str(5001 + i) for i in range(count)], {}
+    keys = [signatures.generate_key() for _ in range(count)]
+    accounts = [signatures.address(signatures.public_key_hex(key)) for key in keys]
+    return accounts, dict(zip(accounts, keys))
+
+
+def make_chain(height, txs_per_block, account_count=50, seed=0, signed=False):
+    # A linked chain of `height` blocks plus genesis. Blocks are mined at the
+    # easiest target and spaced so that it never retargets, which costs a few
+    # hashes per block.
+    rng = random.Random(seed)
+    accounts, keys = make_accounts(account_count, signed)
+    nonces = dict.fromkeys(accounts, 0)
+    timestamp = datetime.datetime(2024, 1, 1)
+    genesis = Block(0, timestamp, [Transaction("genesis", account, 1_000_000) for account in accounts], "0", target=MAX_TARGET)
+    chain = [genesis]
+    for index in range(1, height + 1):
+        transactions = []
+        for _ in range(txs_per_block):
+            sender = rng.choice(accounts)
+            transaction = Transaction(sender, rng.choice(accounts), float(rng.randint(1, 100)), nonce=nonces[sender])
+            nonces[sender] += 1
+            if signed:
+                transaction.sign(keys[sender])
+            transactions.append(transaction)
+        timestamp += datetime.timedelta(seconds=TARGET_BLOCK_SECONDS)
+        block = Block(index, timestamp, transactions, chain[-1].hash, target=MAX_TARGET)
+        block.mine_block()
+        chain.append(block)
+    return chain
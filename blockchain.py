@@ -1,53 +1,318 @@
+import collections
+import concurrent.futures
 import hashlib
 import datetime
-import sqlite3
 import json
+import itertools
+import math
+import os
+import sys
+import time
+import blocktree
+import encoding
+import mempool
+import merkle
+import metrics
+import mining
+import signatures
+import snapshot
+import storage
+
+# Version 1 blocks hash the Python repr of their fields, version 2 blocks hash
+# a binary header that commits to the Merkle root of the transactions, version 3
+# adds the fee and nonce of each transaction to its encoding, version 4 its
+# public key and signature and version 5 records the proof of work target in
+# the header.
+LEGACY_BLOCK_VERSION = 1
+BLOCK_VERSION = 5
+SIGNED_BLOCK_VERSION = 4
+TARGET_BLOCK_VERSION = 5
+
+SCHEMA_VERSION = 12
+
+# The target is retargeted every RETARGET_INTERVAL blocks so that blocks come
+# TARGET_BLOCK_SECONDS apart, moving at most MAX_RETARGET_FACTOR times each time.
+RETARGET_INTERVAL = 20
+TARGET_BLOCK_SECONDS = 30
+MAX_RETARGET_FACTOR = 4
+# Easiest target allowed: one leading hex zero
+MAX_TARGET = mining.difficulty_limit(1)
+# How far ahead of our clock a block timestamp may be
+MAX_FUTURE_SECONDS = 2 * 60 * 60
+# Blocks from before targets were recorded count as mined at the default difficulty
+LEGACY_TARGET = mining.difficulty_limit(4)
+# Side branches forking further below the tip than this are forgotten
+SIDE_BRANCH_DEPTH = 100
+
+# Blocks are validated in windows of this many: first the checks that need
+# nothing but the block, split over a process pool once a window has at least
+# MIN_PARALLEL_BLOCKS blocks, then the checks that depend on the block before.
+VALIDATION_WINDOW = 2000
+MIN_PARALLEL_BLOCKS = 64
+
+# Senders that create coins instead of spending them
+GENESIS_SENDER = "genesis"
+# Coins the genesis block gives each of the accounts it funds
+GENESIS_AMOUNT = 100
+FEES_SENDER = "fees"
+MINT_SENDERS = (GENESIS_SENDER, FEES_SENDER)
+
+MAX_BLOCK_TRANSACTIONS = 500
+
+# How many blocks back a reorg can be undone without replaying the whole chain
+UNDO_DEPTH = 1000
+
+# Balances are floats, so a balance spent to the last coin can be off by rounding
+BALANCE_TOLERANCE = 1e-9
+
+# Published balances are split in this many dicts, so a new block only copies
+# the ones holding accounts it touched
+BALANCE_SHARDS = 256
+
+ADD_BLOCK_SECONDS = metrics.Histogram('blockchain_add_block_seconds', 'Tiempo de Blockchain.add_block, minado incluido')
+MINE_BLOCK_SECONDS = metrics.Histogram('blockchain_mine_block_seconds', 'Tiempo de minado de un bloque')
+MINING_HASHES = metrics.Counter('blockchain_mining_hashes_total', 'Nonces probados al minar')
+MINING_HASH_RATE = metrics.Gauge('blockchain_mining_hash_rate', 'Hashes por segundo del último bloque minado')
+VALIDATION_SECONDS = metrics.Histogram('blockchain_validation_seconds', 'Tiempo de Blockchain.is_chain_valid')
+FORK_VALIDATION_SECONDS = metrics.Histogram('blockchain_fork_validation_seconds', 'Tiempo de validación de una cadena recibida')
+DB_WRITE_SECONDS = metrics.Histogram('blockchain_db_write_seconds', 'Tiempo de Blockchain.add_block_to_db')
+
+def utc_now():
+    # Block timestamps are naive datetimes in UTC, so every node compares
+    # them the same way whatever its time zone
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
 
 class Transaction:
-    def __init__(self, sender, recipient, amount):
+    __slots__ = ('sender', 'recipient', 'amount', 'fee', 'nonce', 'public_key', 'signature')
+
+    def __init__(self, sender, recipient, amount, fee=0, nonce=0, public_key='', signature=''):
         self.sender = sender
         self.recipient = recipient
         self.amount = amount
+        self.fee = fee
+        self.nonce = nonce
+        self.public_key = public_key
+        self.signature = signature
+
+    def encode(self, version=BLOCK_VERSION, include_signature=True):
+        data = encoding.encode_transaction(self.sender, self.recipient, self.amount)
+        if version >= 3:
+            data += encoding.encode_amount(self.fee) + encoding.encode_varint(self.nonce)
+        if version >= SIGNED_BLOCK_VERSION:
+            data += encoding.encode_bytes(bytes.fromhex(self.public_key))
+            if include_signature:
+                data += encoding.encode_bytes(bytes.fromhex(self.signature))
+        return data
+
+    def signing_payload(self):
+        return self.encode(SIGNED_BLOCK_VERSION, include_signature=False)
+
+    def sign(self, private_key):
+        self.public_key = signatures.public_key_hex(private_key)
+        self.signature = signatures.sign(private_key, self.signing_payload())
+
+    def hash(self):
+        return hashlib.sha256(self.encode()).hexdigest()
+
+    def is_well_formed(self, version=BLOCK_VERSION):
+        if not (isinstance(self.sender, str) and isinstance(self.recipient, str) and self.sender and self.recipient):
+            return False
+        if not isinstance(self.amount, (int, float)) or not math.isfinite(self.amount) or self.amount <= 0:
+            return False
+        if not isinstance(self.fee, (int, float)) or not math.isfinite(self.fee) or self.fee < 0:
+            return False
+        if not isinstance(self.nonce, int) or self.nonce < 0:
+            return False
+        if version >= SIGNED_BLOCK_VERSION and self.sender not in MINT_SENDERS:
+            # Whether they are valid hex is left to the signature check
+            return isinstance(self.public_key, str) and len(self.public_key) == 64 and isinstance(self.signature, str) and len(self.signature) == 128
+        return True
 
     def to_dict(self):
-        return {
+        # Fee and nonce are left out when unset so older transactions keep the
+        # exact dict (and version 1 hash preimage) they always had
+        data = {
             'sender': self.sender,
             'recipient': self.recipient,
             'amount': self.amount
         }
+        if self.fee:
+            data['fee'] = self.fee
+        if self.nonce:
+            data['nonce'] = self.nonce
+        if self.signature:
+            data['public_key'] = self.public_key
+            data['signature'] = self.signature
+        return data
 
     @staticmethod
     def from_dict(data):
-        return Transaction(data['sender'], data['recipient'], data['amount'])
+        return Transaction(data['sender'], data['recipient'], data['amount'], data.get('fee', 0), data.get('nonce', 0),
+                           data.get('public_key', ''), data.get('signature', ''))
+
+    def to_row(self):
+        # Positional form used in storage, trailing defaults left out
+        values = [self.sender, self.recipient, self.amount, self.fee, self.nonce, self.public_key, self.signature]
+        while len(values) > 3 and not values[-1]:
+            values.pop()
+        return values
+
+    @staticmethod
+    def from_row(values):
+        # Account names and keys repeat across many transactions, so a single
+        # shared copy of each is kept
+        transaction = Transaction(*values)
+        transaction.sender = sys.intern(transaction.sender)
+        transaction.recipient = sys.intern(transaction.recipient)
+        transaction.public_key = sys.intern(transaction.public_key)
+        return transaction
 
 class Block:
-    def __init__(self, index, timestamp, transactions, previous_hash, nonce=0, hash=None):
+    __slots__ = ('version', 'index', 'timestamp', '_transactions', 'previous_hash', 'nonce', 'hash', 'target', '_payload', '_merkle_root')
+
+    def __init__(self, index, timestamp, transactions, previous_hash, nonce=0, hash=None, version=BLOCK_VERSION, target=None):
+        self.version = version
         self.index = index
         self.timestamp = timestamp
         self.transactions = transactions
         self.previous_hash = previous_hash
         self.nonce = nonce
+        # Proof of work target as an integer, only recorded from version 5 on
+        self.target = target if version >= TARGET_BLOCK_VERSION else None
         self.hash = hash or self.calculate_hash()
 
+    @property
+    def transactions(self):
+        return self._transactions
+
+    @transactions.setter
+    def transactions(self, transactions):
+        # Stored as a tuple and the cached encodings below dropped here. The
+        # transactions themselves are still mutable and changing one in place
+        # leaves the cache (and calculate_hash, and the copy pickled to the
+        # validation pool) stale: to change a transaction, build the new list
+        # and assign it to block.transactions.
+        self._transactions = tuple(transactions)
+        self._payload = None
+        self._merkle_root = None
+
+    def transactions_payload(self):
+        if self._payload is None:
+            if self.version == LEGACY_BLOCK_VERSION:
+                self._payload = str([tx.to_dict() for tx in self._transactions]).encode('utf-8')
+            else:
+                encoded_transactions = [tx.encode(self.version) for tx in self._transactions]
+                self._payload = encoding.encode_transaction_list(encoded_transactions)
+                self._merkle_root = merkle.merkle_root(encoded_transactions)
+        return self._payload
+
+    def merkle_root(self):
+        if self.version == LEGACY_BLOCK_VERSION:
+            return None
+        if self._merkle_root is None:
+            self.transactions_payload()
+        return self._merkle_root
+
+    def mining_prefix(self):
+        # Everything in the hash preimage except the nonce, which always goes last
+        if self.version == LEGACY_BLOCK_VERSION:
+            return (
+                str(self.index).encode('utf-8') +
+                str(self.timestamp).encode('utf-8') +
+                self.transactions_payload() +
+                str(self.previous_hash).encode('utf-8')
+            )
+        return encoding.encode_header_prefix(self.version, self.index, self.timestamp, self.previous_hash, self.merkle_root(), self.target)
+
+    def nonce_encoder(self):
+        if self.version == LEGACY_BLOCK_VERSION:
+            return encoding.encode_legacy_nonce
+        return encoding.encode_nonce
+
     def calculate_hash(self):
         sha = hashlib.sha256()
-        sha.update(
-            str(self.index).encode('utf-8') +
-            str(self.timestamp).encode('utf-8') +
-            str([tx.to_dict() for tx in self.transactions]).encode('utf-8') +
-            str(self.previous_hash).encode('utf-8') +
-            str(self.nonce).encode('utf-8')
-        )
+        sha.update(self.mining_prefix() + self.nonce_encoder()(self.nonce))
         return sha.hexdigest()
 
-    def mine_block(self, difficulty):
-        target = '0' * difficulty
-        while self.hash[:difficulty] != target:
-            self.nonce += 1
-            self.hash = self.calculate_hash()
+    def mine_block(self, workers=1, stop=None):
+        # False if `stop` returned true before a nonce was found
+        start, started = self.nonce, time.perf_counter()
+        result = mining.mine_parallel(self.mining_prefix(), self.target, self.nonce_encoder(), workers, self.nonce, stop)
+        if result is None:
+            return False
+        self.nonce, self.hash = result
+        if metrics.enabled:
+            # Workers scan consecutive chunks, so the winning nonce approximates the hashes tried
+            elapsed = time.perf_counter() - started
+            MINING_HASHES.inc(self.nonce - start + 1)
+            MINING_HASH_RATE.set((self.nonce - start + 1) / elapsed)
+            MINE_BLOCK_SECONDS.observe(elapsed)
+        return True
 
-    def to_dict(self):
+    def header(self):
+        # What a light client or a syncing peer needs to check the block without
+        # its transactions. Version 1 headers can only be checked with the body.
         return {
+            'version': self.version,
+            'index': self.index,
+            'timestamp': self.timestamp.isoformat(),
+            'previous_hash': self.previous_hash,
+            'merkle_root': None if self.version == LEGACY_BLOCK_VERSION else self.merkle_root().hex(),
+            'target': None if self.target is None else encoding.encode_target(self.target).hex(),
+            'nonce': self.nonce,
+            'hash': self.hash
+        }
+
+    @staticmethod
+    def header_hash(header):
+        prefix = encoding.encode_header_prefix(
+            header['version'],
+            header['index'],
+            datetime.datetime.fromisoformat(header['timestamp']),
+            header['previous_hash'],
+            bytes.fromhex(header['merkle_root']),
+            Block.header_target(header)
+        )
+        return hashlib.sha256(prefix + encoding.encode_nonce(header['nonce'])).hexdigest()
+
+    @staticmethod
+    def header_target(header):
+        if header['version'] < TARGET_BLOCK_VERSION:
+            return None
+        return int(header['target'], 16)
+
+    @staticmethod
+    def header_work(header):
+        if header['index'] == 0:
+            return 0
+        return mining.target_work(Block.header_target(header) or LEGACY_TARGET)
+
+    def work(self):
+        # A genesis block is not mined, so the target it claims proves nothing
+        if self.index == 0:
+            return 0
+        return mining.target_work(self.target or LEGACY_TARGET)
+
+    def has_valid_work(self):
+        # Only checks the hash against the target the block claims; whether that
+        # target is the right one depends on the chain before it. Blocks without
+        # a target only pass validate_blocks as history we already checkpointed.
+        if self.version < TARGET_BLOCK_VERSION or self.index == 0:
+            return True
+        return self.target is not None and mining.meets_target(self.hash, self.target)
+
+    @staticmethod
+    def verify_header(header):
+        if header.get('version', LEGACY_BLOCK_VERSION) == LEGACY_BLOCK_VERSION:
+            return True
+        if Block.header_hash(header) != header['hash']:
+            return False
+        target = Block.header_target(header)
+        return target is None or header['index'] == 0 or mining.meets_target(header['hash'], target)
+
+    def to_dict(self):
+        data = {
+            'version': self.version,
             'index': self.index,
             'timestamp': self.timestamp.isoformat(),
             'transactions': [tx.to_dict() for tx in self.transactions],
@@ -55,6 +320,9 @@ class Block:
             'nonce': self.nonce,
             'hash': self.hash
         }
+        if self.target is not None:
+            data['target'] = encoding.encode_target(self.target).hex()
+        return data
 
     @staticmethod
     def from_dict(data):
@@ -64,18 +332,149 @@ class Block:
             [Transaction.from_dict(tx) for tx in data['transactions']],
             data['previous_hash'],
             data['nonce'],
-            data['hash']
+            data['hash'],
+            data.get('version', LEGACY_BLOCK_VERSION),  # Peers that predate versioning only send version 1 blocks
+            int(data['target'], 16) if data.get('target') else None
         )
 
+    @staticmethod
+    def from_header(header):
+        block = Block(header['index'], datetime.datetime.fromisoformat(header['timestamp']), [], header['previous_hash'],
+                      header['nonce'], header['hash'], header['version'], Block.header_target(header))
+        block._merkle_root = bytes.fromhex(header['merkle_root'])
+        return block
+
+    @staticmethod
+    def from_row(row):
+        if row[2] is None:
+            # Below a snapshot only the header was ever downloaded
+            return Block.from_header({
+                'index': row[0],
+                'timestamp': row[1],
+                'previous_hash': row[3],
+                'nonce': row[4],
+                'hash': row[5],
+                'version': row[6],
+                'merkle_root': row[7],
+                'target': row[8]
+            })
+        # Rows written before transactions were stored as lists hold dicts
+        transactions = [Transaction.from_dict(tx) if isinstance(tx, dict) else Transaction.from_row(tx) for tx in json.loads(row[2])]
+        return Block(row[0], datetime.datetime.fromisoformat(row[1]), transactions, row[3], row[4], row[5], row[6],
+                     int(row[8], 16) if row[8] else None)
+
+def check_block(block):
+    # Everything about a block that does not depend on the chain before it
+    if block.hash != block.calculate_hash() or not block.has_valid_work():
+        return False
+    return all(tx.is_well_formed(block.version) for tx in block.transactions)
+
+def check_block_chunk(blocks):
+    return [check_block(block) for block in blocks]
+
+def signed_spends(blocks):
+    # Transactions whose signature a block vouches for
+    return [tx for block in blocks if block.version >= SIGNED_BLOCK_VERSION for tx in block.transactions if tx.sender not in MINT_SENDERS]
+
+class AccountState:
+    # Balances and nonces as of block `start` of a chain, while a received
+    # suffix is applied on top. Accounts the suffix has not touched are read
+    # from `balances` and `nonces`, which are never modified.
+    def __init__(self, start, balances, nonces, changes=None):
+        self.start = start
+        self.balances = balances
+        self.nonces = nonces
+        self.changes = dict(changes or {})
+
+    def get(self, account):
+        if account in self.changes:
+            return self.changes[account]
+        return self.balances.get(account, 0), self.nonces.get(account, 0)
+
+    def apply(self, block):
+        # False if the block has too many transactions, reuses or skips a
+        # nonce, or leaves an account with a negative balance
+        if sum(1 for tx in block.transactions if tx.sender not in MINT_SENDERS) > MAX_BLOCK_TRANSACTIONS:
+            return False
+        for tx in block.transactions:
+            if tx.sender not in MINT_SENDERS:
+                amount, nonce = self.get(tx.sender)
+                if block.version >= 3 and tx.nonce != nonce:
+                    return False
+                amount -= tx.amount + tx.fee
+                if amount < -BALANCE_TOLERANCE:
+                    return False
+                self.changes[tx.sender] = (amount, nonce + 1)
+            amount, nonce = self.get(tx.recipient)
+            self.changes[tx.recipient] = (amount + tx.amount, nonce)
+        return True
+
+def balance_shard(account):
+    return hash(account) % BALANCE_SHARDS
+
+class ChainState:
+    # What other threads see of the chain. A new one replaces the old after
+    # every change and none is ever modified, so reading it takes no lock.
+    # Consecutive states share the balance shards that did not change.
+    __slots__ = ('height', 'tip_hash', 'work', 'shards')
+
+    def __init__(self, height, tip_hash, work, shards):
+        self.height = height
+        self.tip_hash = tip_hash
+        self.work = work
+        self.shards = shards
+
+    def balance(self, account):
+        return self.shards[balance_shard(account)].get(account, 0)
+
 class Blockchain:
-    def __init__(self, difficulty=4, db_path='blockchain.db'):
+    def __init__(self, difficulty=4, db_path='blockchain.db', mining_workers=1, synchronous='NORMAL', verify_workers=None, validation_workers=None,
+                 genesis_accounts=()):
         self.difficulty = difficulty
+        # Accounts funded by the genesis block, if this database needs one
+        self.genesis_accounts = genesis_accounts
+        self.mining_workers = mining_workers
+        self.verifier = signatures.SignatureVerifier(verify_workers)
+        self.validation_workers = validation_workers or os.cpu_count() or 1
+        self.validation_pool = None
         self.db_path = db_path
-        self.conn = sqlite3.connect(self.db_path)
+        self.conn = storage.connect(self.db_path, synchronous)
         self.create_table()
+        # Blocks up to this height only have headers, their state came from a snapshot
+        self.snapshot_height = int(self.get_state('snapshot_height') or -1)
         self.chain = self.load_chain()
-        self.pending_transactions = []
+        self.validated_height, self.validated_hash = self.load_checkpoint()
+        self.mempool = mempool.Mempool()
         self.balances = self.load_balances()  # Initialize balances after loading the chain
+        self.load_tx_index()
+        self.load_chain_work()
+        # Received blocks that are not on the main chain
+        self.side_blocks = blocktree.BlockTree()
+        self.orphans = blocktree.OrphanPool()
+        self.publish_state()
+
+    def publish_state(self, changed=None):
+        # Everything else on this object belongs to the thread that writes the
+        # chain. `changed` are the accounts whose balance changed since the last
+        # state; without it every balance is copied.
+        tip = self.get_latest_block()
+        if changed is None:
+            shards = [{} for _ in range(BALANCE_SHARDS)]
+            for account, amount in self.balances.items():
+                shards[balance_shard(account)][account] = amount
+        else:
+            shards = list(self.published.shards)
+            copied = set()
+            for account in changed:
+                shard = balance_shard(account)
+                if shard not in copied:
+                    shards[shard] = dict(shards[shard])
+                    copied.add(shard)
+                if account in self.balances:
+                    shards[shard][account] = self.balances[account]
+                else:
+                    shards[shard].pop(account, None)
+        self.published = ChainState(tip.index, tip.hash, self.chain_work(), tuple(shards))
 
     def create_table(self):
         with self.conn:
@@ -87,127 +486,884 @@ class Blockchain:
                                     nonce INTEGER,
                                     hash TEXT
                                 )''')
+        self.migrate_schema()
+
+    def migrate_schema(self):
+        # Each step upgrades a database stored by an older release by one version
+        migrations = {
+            0: ['ALTER TABLE blocks ADD COLUMN version INTEGER NOT NULL DEFAULT 1'],
+            1: ['CREATE TABLE chain_state (key TEXT PRIMARY KEY, value TEXT)'],
+            2: ['CREATE TABLE balances (account TEXT PRIMARY KEY, amount REAL NOT NULL)',
+                '''CREATE TABLE balance_undo (
+                       block_index INTEGER NOT NULL,
+                       account TEXT NOT NULL,
+                       previous_amount REAL,
+                       PRIMARY KEY (block_index, account)
+                   )'''],
+            3: ['CREATE UNIQUE INDEX blocks_hash ON blocks (hash)'],
+            4: ['ALTER TABLE balances ADD COLUMN nonce INTEGER NOT NULL DEFAULT 0',
+                'ALTER TABLE balance_undo ADD COLUMN previous_nonce INTEGER',
+                # Account nonces are derived from history, so replay it once
+                "DELETE FROM chain_state WHERE key = 'balances_height'"],
+            # Public key each account signed with first, pinned by the block that used it
+            5: ['''CREATE TABLE account_keys (
+                       account TEXT PRIMARY KEY,
+                       public_key TEXT NOT NULL,
+                       block_index INTEGER NOT NULL
+                   )'''],
+            # Where each transaction is and which transactions touch each
+            # account. The same transaction can appear in several blocks.
+            6: ['''CREATE TABLE tx_index (
+                       tx_hash BLOB NOT NULL,
+                       block_index INTEGER NOT NULL,
+                       position INTEGER NOT NULL,
+                       PRIMARY KEY (tx_hash, block_index, position)
+                   ) WITHOUT ROWID''',
+                'CREATE INDEX tx_index_block ON tx_index (block_index)',
+                '''CREATE TABLE address_tx (
+                       account TEXT NOT NULL,
+                       block_index INTEGER NOT NULL,
+                       position INTEGER NOT NULL,
+                       PRIMARY KEY (account, block_index, position)
+                   ) WITHOUT ROWID''',
+                'CREATE INDEX address_tx_block ON address_tx (block_index)'],
+            # Header-only blocks and the account state of an imported snapshot
+            7: ['ALTER TABLE blocks ADD COLUMN merkle_root TEXT',
+                'CREATE TABLE snapshot_accounts (account TEXT PRIMARY KEY, amount REAL NOT NULL, nonce INTEGER NOT NULL)'],
+            # Proof of work target recorded by version 5 blocks
+            8: ['ALTER TABLE blocks ADD COLUMN target TEXT'],
+            # Cumulative work of the main chain up to each block, in hex
+            9: ['CREATE TABLE chain_work (block_index INTEGER PRIMARY KEY, work TEXT NOT NULL)'],
+            # Genesis blocks no longer count as work, so add it up again
+            10: ["DELETE FROM chain_state WHERE key = 'chain_work_height'"],
+            # Accounts are derived from their key now, nothing to pin
+            11: ['DROP TABLE account_keys'],
+        }
+        schema_version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        while schema_version < SCHEMA_VERSION:
+            with self.conn:
+                for statement in migrations[schema_version]:
+                    self.conn.execute(statement)
+                schema_version += 1
+                self.conn.execute(f'PRAGMA user_version = {schema_version}')
 
     def create_genesis_block(self):
-        genesis_transactions = [
-            Transaction("genesis", "5001", 100),
-            Transaction("genesis", "5002", 100),
-            Transaction("genesis", "5003", 100),
-            Transaction("genesis", "5004", 100)
-        ]
-        genesis_block = Block(0, datetime.datetime.now(), genesis_transactions, "0")
+        genesis_transactions = [Transaction(GENESIS_SENDER, account, GENESIS_AMOUNT) for account in self.genesis_accounts]
+        genesis_block = Block(0, utc_now(), genesis_transactions, "0", target=mining.difficulty_limit(self.difficulty))
         self.add_block_to_db(genesis_block)
         return genesis_block
 
     def load_chain(self):
+        # Blocks stay on disk, the view decodes them when they are accessed
+        if self.conn.execute('SELECT 1 FROM blocks LIMIT 1').fetchone() is None:
+            self.create_genesis_block()
+        return storage.ChainView(self.conn, Block.from_row)
+
+    def load_checkpoint(self):
+        # Height and hash of the last block known to be valid, so restarts and
+        # later validations only look at blocks above it.
+        rows = dict(self.conn.execute("SELECT key, value FROM chain_state WHERE key IN ('validated_height', 'validated_hash')"))
+        if 'validated_height' not in rows:
+            return self.checkpoint_legacy_history()
+        return int(rows['validated_height']), rows['validated_hash']
+
+    def checkpoint_legacy_history(self):
+        # Databases from before checkpoints hold blocks without a target, which
+        # validate_blocks only accepts below the checkpoint. They are checked
+        # once here under the rules they were mined with (hash and link), and
+        # the last of them becomes the checkpoint.
+        height, block_hash = 0, self.chain[0].hash
+        previous = self.chain[0]
+        for block in self.chain.iter_from(1):
+            if block.version >= TARGET_BLOCK_VERSION:
+                break
+            if block.version < previous.version or block.previous_hash != previous.hash or block.hash != block.calculate_hash():
+                break
+            height, block_hash = block.index, block.hash
+            previous = block
+        if height > 0:
+            self.save_checkpoint(height, block_hash)
+        return height, block_hash
+
+    def save_checkpoint(self, height, block_hash):
         with self.conn:
-            cursor = self.conn.execute('SELECT * FROM blocks ORDER BY block_index ASC')
-            rows = cursor.fetchall()
-            if not rows:
-                return [self.create_genesis_block()]
-            return [Block.from_dict({
-                'index': row[0],
-                'timestamp': row[1],
-                'transactions': json.loads(row[2]),
-                'previous_hash': row[3],
-                'nonce': row[4],
-                'hash': row[5]
-            }) for row in rows]
+            self.conn.executemany('INSERT OR REPLACE INTO chain_state (key, value) VALUES (?, ?)',
+                                  [('validated_height', str(height)), ('validated_hash', block_hash)])
+        self.validated_height, self.validated_hash = height, block_hash
+
+    @staticmethod
+    def balance_deltas(transactions):
+        # Amount change per account and the nonce each sender moves to
+        deltas = {}
+        nonces = {}
+        for tx in transactions:
+            if tx.sender not in MINT_SENDERS:
+                deltas[tx.sender] = deltas.get(tx.sender, 0) - tx.amount - tx.fee
+                nonces[tx.sender] = max(nonces.get(tx.sender, 0), tx.nonce + 1)
+            deltas[tx.recipient] = deltas.get(tx.recipient, 0) + tx.amount
+        return deltas, nonces
+
+    def get_state(self, key):
+        row = self.conn.execute('SELECT value FROM chain_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO chain_state (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def load_accounts(self):
+        # The balances table is kept in step with the blocks table, so this is a
+        # read of one row per account. Databases that are behind are replayed once.
+        if self.get_state('balances_height') != str(self.chain[-1].index):
+            return self.rebuild_balances()
+        return {account: (amount, nonce) for account, amount, nonce in self.conn.execute('SELECT account, amount, nonce FROM balances')}
 
     def load_balances(self):
-        balances = {}
-        for block in self.chain:
-            for tx in block.transactions:
-                if tx.sender != "genesis":
-                    if tx.sender in balances:
-                        balances[tx.sender] -= tx.amount
-                    else:
-                        balances[tx.sender] = -tx.amount
-                if tx.recipient in balances:
-                    balances[tx.recipient] += tx.amount
-                else:
-                    balances[tx.recipient] = tx.amount
-        return balances
+        accounts = self.load_accounts()
+        self.nonces = {account: nonce for account, (_, nonce) in accounts.items()}
+        return {account: amount for account, (amount, _) in accounts.items()}
+
+    def replay_accounts(self):
+        accounts = {account: (amount, nonce) for account, amount, nonce in self.conn.execute('SELECT account, amount, nonce FROM snapshot_accounts')}
+        for block in self.chain.iter_from(self.snapshot_height + 1):
+            deltas, nonces = self.balance_deltas(block.transactions)
+            for account, delta in deltas.items():
+                amount, nonce = accounts.get(account, (0, 0))
+                accounts[account] = (amount + delta, max(nonce, nonces.get(account, 0)))
+        return accounts
+
+    def rebuild_balances(self):
+        accounts = self.replay_accounts()
+        with self.conn:
+            self.conn.execute('DELETE FROM balances')
+            self.conn.execute('DELETE FROM balance_undo')
+            self.conn.executemany(storage.UPSERT_BALANCE, [(account, amount, nonce) for account, (amount, nonce) in accounts.items()])
+            self.set_state('balances_height', self.chain[-1].index)
+        return accounts
+
+    def verify_balances(self):
+        stored = {account: (amount, nonce) for account, amount, nonce in self.conn.execute('SELECT account, amount, nonce FROM balances')}
+        return self.replay_accounts() == stored
+
+    def apply_balances(self, blocks):
+        # Must run inside the transaction that stores the blocks. Records the
+        # previous state of every account a block touches so a reorg can undo it.
+        changes = {}
+        undo_rows = []
+        for block in blocks:
+            deltas, nonces = self.balance_deltas(block.transactions)
+            for account, delta in deltas.items():
+                if account not in changes:
+                    changes[account] = self.conn.execute(storage.SELECT_BALANCE, (account,)).fetchone()
+                previous = changes[account]
+                undo_rows.append((block.index, account) + (previous if previous else (None, None)))
+                amount, nonce = previous or (0, 0)
+                changes[account] = (amount + delta, max(nonce, nonces.get(account, 0)))
+        self.conn.executemany(storage.INSERT_UNDO, undo_rows)
+        self.conn.executemany(storage.UPSERT_BALANCE, [(account, amount, nonce) for account, (amount, nonce) in changes.items()])
+        self.conn.execute('DELETE FROM balance_undo WHERE block_index < ?', (blocks[-1].index - UNDO_DEPTH,))
+        self.set_state('balances_height', blocks[-1].index)
+        return changes
+
+    def rollback_balances(self, fork_point):
+        # Undo records are applied newest first, so each account ends with the
+        # state it had before block `fork_point`. Returns the restored accounts,
+        # None for the ones that did not exist yet, or None when the undo
+        # history does not reach that far back.
+        if fork_point > self.chain[-1].index:
+            return {}
+        oldest = self.conn.execute('SELECT MIN(block_index) FROM balance_undo').fetchone()[0]
+        if oldest is None or oldest > fork_point:
+            return None
+        rows = self.conn.execute('SELECT account, previous_amount, previous_nonce FROM balance_undo WHERE block_index >= ? ORDER BY block_index DESC',
+                                 (fork_point,)).fetchall()
+        restored = {}
+        for account, previous_amount, previous_nonce in rows:
+            if previous_amount is None:
+                self.conn.execute('DELETE FROM balances WHERE account = ?', (account,))
+                restored[account] = None
+            else:
+                self.conn.execute(storage.UPSERT_BALANCE, (account, previous_amount, previous_nonce))
+                restored[account] = (previous_amount, previous_nonce)
+        self.conn.execute('DELETE FROM balance_undo WHERE block_index >= ?', (fork_point,))
+        self.set_state('balances_height', fork_point - 1)
+        return restored
+
+    def apply_account_changes(self, changes):
+        for account, state in changes.items():
+            if state is None:
+                self.balances.pop(account, None)
+                self.nonces.pop(account, None)
+            else:
+                self.balances[account], self.nonces[account] = state
+
+    def index_transactions(self, blocks):
+        # Must run inside the transaction that stores the blocks
+        tx_rows = []
+        address_rows = []
+        for block in blocks:
+            for position, tx in enumerate(block.transactions):
+                tx_rows.append((bytes.fromhex(tx.hash()), block.index, position))
+                address_rows.append((tx.sender, block.index, position))
+                address_rows.append((tx.recipient, block.index, position))
+        self.conn.executemany(storage.INSERT_TX_INDEX, tx_rows)
+        self.conn.executemany(storage.INSERT_ADDRESS_TX, address_rows)
+        self.set_state('tx_index_height', blocks[-1].index)
+
+    def load_tx_index(self):
+        # Databases from before the index existed are indexed once
+        if self.get_state('tx_index_height') == str(self.chain[-1].index):
+            return
+        with self.conn:
+            self.conn.execute('DELETE FROM tx_index')
+            self.conn.execute('DELETE FROM address_tx')
+            for start in range(0, len(self.chain), self.chain.page_size):
+                self.index_transactions(list(self.chain.iter_from(start, start + self.chain.page_size)))
+
+    def record_work(self, blocks):
+        # Must run inside the transaction that stores the blocks
+        work = self.work_before(blocks[0].index)
+        rows = []
+        for block in blocks:
+            work += block.work()
+            rows.append((block.index, format(work, 'x')))
+        self.conn.executemany(storage.INSERT_CHAIN_WORK, rows)
+        self.set_state('chain_work_height', blocks[-1].index)
+
+    def load_chain_work(self):
+        # Databases from before chain work was stored add it up once
+        if self.get_state('chain_work_height') == str(self.chain[-1].index):
+            return
+        with self.conn:
+            self.conn.execute('DELETE FROM chain_work')
+            for start in range(0, len(self.chain), self.chain.page_size):
+                self.record_work(list(self.chain.iter_from(start, start + self.chain.page_size)))
+
+    def work_at(self, index):
+        return int(self.conn.execute(storage.SELECT_CHAIN_WORK, (index,)).fetchone()[0], 16)
+
+    def work_before(self, index):
+        return self.work_at(index - 1) if index > 0 else 0
 
+    def chain_work(self):
+        return self.work_at(len(self.chain) - 1)
+
+    def store_block(self, block):
+        # Callers own the surrounding transaction
+        cursor = self.conn.execute(storage.INSERT_BLOCK_IF_NEW, storage.block_row(block))
+        if cursor.rowcount == 0:
+            return {}
+        self.index_transactions([block])
+        self.record_work([block])
+        return self.apply_balances([block])
+
+    def store_blocks(self, blocks):
+        # Bulk import of consecutive blocks. A block that is already stored
+        # aborts the whole surrounding transaction.
+        if not blocks:
+            return {}
+        self.conn.executemany(storage.INSERT_BLOCK, [storage.block_row(block) for block in blocks])
+        self.index_transactions(blocks)
+        self.record_work(blocks)
+        return self.apply_balances(blocks)
+
+    @metrics.timed(DB_WRITE_SECONDS)
     def add_block_to_db(self, block):
         with self.conn:
-            cursor = self.conn.execute('SELECT * FROM blocks WHERE hash = ?', (block.hash,))
-            if cursor.fetchone() is None:
-                self.conn.execute('INSERT INTO blocks (block_index, timestamp, transactions, previous_hash, nonce, hash) VALUES (?, ?, ?, ?, ?, ?)',
-                                  (block.index, block.timestamp.isoformat(), json.dumps([tx.to_dict() for tx in block.transactions]), block.previous_hash, block.nonce, block.hash))
+            return self.store_block(block)
 
     def get_latest_block(self):
         return self.chain[-1]
 
-    def add_block(self, transactions):
+    @metrics.timed(ADD_BLOCK_SECONDS)
+    def add_block(self, transactions, workers=None):
+        new_block = self.block_template(transactions)
+        new_block.mine_block(workers or self.mining_workers)
+        return self.append_mined(new_block)
+
+    def block_template(self, transactions):
         latest_block = self.get_latest_block()
-        new_block = Block(len(self.chain), datetime.datetime.now(), transactions, latest_block.hash)
-        new_block.mine_block(self.difficulty)
-        
-        # Ensure the new block's hash is calculated after mining
-        new_block.hash = new_block.calculate_hash()
-        
-        # Append the new block to the chain
-        self.chain.append(new_block)
-        self.add_block_to_db(new_block)
-        self.update_balances(transactions)
+        # Blocks mined before timestamps were in UTC may be ahead of it
+        timestamp = max(utc_now(), latest_block.timestamp)
+        return Block(len(self.chain), timestamp, transactions, latest_block.hash, target=self.next_target(latest_block))
+
+    def append_mined(self, new_block):
+        # A block mined from a template is dropped if our tip moved meanwhile
+        if new_block.previous_hash != self.get_latest_block().hash:
+            print("El bloque minado quedó obsoleto: la cadena cambió mientras se minaba.\n")
+            return None
+        self.append_block(new_block)
         print(f"Nuevo bloque minado: {new_block.hash}\n")
         return new_block
 
-    def update_balances(self, transactions):
-        for tx in transactions:
-            if tx.sender in self.balances:
-                self.balances[tx.sender] -= tx.amount
-            else:
-                self.balances[tx.sender] = -tx.amount
-            if tx.recipient in self.balances:
-                self.balances[tx.recipient] += tx.amount
-            else:
-                self.balances[tx.recipient] = tx.amount
+    def append_block(self, new_block):
+        # The block must already be valid on top of our tip. It is stored
+        # first, so a failed write leaves the view matching the database.
+        changes = self.add_block_to_db(new_block)
+        self.chain.append(new_block)
+        self.apply_account_changes(changes)
+        self.mempool.remove_confirmed(new_block.transactions, self.nonces)
+        if self.validated_height == new_block.index - 1:
+            self.save_checkpoint(new_block.index, new_block.hash)
+        self.side_blocks.prune(new_block.index - SIDE_BRANCH_DEPTH)
+        self.publish_state(changes)
+
+    def accept_block(self, block):
+        # Adds a block mined elsewhere as it is. Returns 'added' if it extends
+        # our tip, 'reorg' if its branch now has the most work, 'side' if it is
+        # kept on a branch with less work, 'orphan' while its parent is missing,
+        # 'stale' if it forks too far below the tip, 'known' or 'invalid'.
+        if block.hash in self.side_blocks or block.hash in self.orphans or self.index_of(block.hash) is not None:
+            return 'known'
+        # A new block always records its target, older versions are only history
+        if block.version < TARGET_BLOCK_VERSION or block.target > MAX_TARGET:
+            return 'invalid'
+        if block.hash != block.calculate_hash() or not block.has_valid_work():
+            return 'invalid'
+        result = self.connect_block(block)
+        # Orphans waiting on this block, and on those in turn, can go in now
+        waiting = self.orphans.pop_children(block.hash) if result in ('added', 'reorg', 'side') else []
+        while waiting:
+            child = waiting.pop()
+            if self.connect_block(child) in ('added', 'reorg', 'side'):
+                waiting.extend(self.orphans.pop_children(child.hash))
+        return result
 
-    def add_transaction(self, sender, recipient, amount):
-        if sender != "genesis" and (sender not in self.balances or self.balances[sender] < amount):
-            print(f"Transacción de {sender} a {recipient} por la cantidad de{amount} falló: no hay saldo suficiente.\n")
+    def connect_block(self, block):
+        tip = self.get_latest_block()
+        if block.previous_hash == tip.hash:
+            if not self.validate_blocks(tip, [block], self.account_state(block.index)) or not self.check_transactions([block]):
+                return 'invalid'
+            self.append_block(block)
+            return 'added'
+
+        parent = self.side_blocks.get(block.previous_hash)
+        if parent is None:
+            parent_index = self.index_of(block.previous_hash)
+            if parent_index is None:
+                self.orphans.add(block)
+                return 'orphan'
+            parent = (self.chain[parent_index], self.work_at(parent_index))
+        if block.index != parent[0].index + 1:
+            return 'invalid'
+        if block.index <= len(self.chain) - SIDE_BRANCH_DEPTH:
+            return 'stale'
+        # Otherwise a block claiming an easy target would be kept for free
+        window_start = self.window_start(parent[0]) if block.index % RETARGET_INTERVAL == 0 else None
+        if block.target != self.next_target(parent[0], window_start):
+            return 'invalid'
+        # Side branches are only fully validated once they have more work than our chain
+        work = parent[1] + block.work()
+        self.side_blocks.add(block, work)
+        if work <= self.chain_work():
+            return 'side'
+
+        branch = self.side_blocks.branch(block.hash)
+        fork_point = branch[0].index
+        replaced = list(self.chain.iter_from(fork_point))
+        self.side_blocks.remove([branch_block.hash for branch_block in branch])
+        if not self.replace_chain(fork_point, branch):
+            return 'invalid'
+        # The blocks we had can still come back if their branch overtakes this one
+        work = self.work_before(fork_point)
+        for replaced_block in replaced:
+            work += replaced_block.work()
+            self.side_blocks.add(replaced_block, work)
+        return 'reorg'
+
+    @property
+    def pending_transactions(self):
+        return list(self.mempool)
+
+    def verify_signatures(self, transactions):
+        # A transaction that cannot even be encoded (a key or signature that is
+        # not hex) is only invalid itself, the rest are still checked
+        results = [False] * len(transactions)
+        items, positions = [], []
+        for position, tx in enumerate(transactions):
+            try:
+                items.append((tx.hash(), tx.public_key, tx.signature, tx.signing_payload()))
+            except (ValueError, TypeError):
+                continue
+            positions.append(position)
+        for position, valid in zip(positions, self.verifier.verify_batch(items)):
+            results[position] = valid
+        return results
+
+    def check_transactions(self, blocks):
+        # Rules for received blocks: they are signed, every spend carries a
+        # valid signature made with the key its account is named after, nobody
+        # mints through the genesis sender and the miner collects at most the
+        # fees of the block.
+        if any(block.version < SIGNED_BLOCK_VERSION for block in blocks):
+            return False
+        if not all(self.verify_signatures(signed_spends(blocks))):
             return False
-        transaction = Transaction(sender, recipient, amount)
-        self.pending_transactions.append(transaction)
-        print(f"Transacción agregada: {sender} -> {recipient}: {amount}\n")
+        for block in blocks:
+            fees = 0
+            for tx in block.transactions:
+                if tx.sender == GENESIS_SENDER:
+                    if block.index > 0:
+                        return False
+                    continue
+                if tx.sender == FEES_SENDER:
+                    fees -= tx.amount
+                    continue
+                if not signatures.owns(tx.public_key, tx.sender):
+                    return False
+                fees += tx.fee
+            if fees < 0:
+                return False
         return True
 
-    def mine_pending_transactions(self):
-        if not self.pending_transactions:
+    def accept_transaction(self, transaction):
+        # Returns the transaction id when it entered the mempool, None otherwise
+        txid, reason = None, None
+        if transaction.sender in MINT_SENDERS:
+            reason = "las cuentas de emisión no pueden enviar transacciones"
+        elif not transaction.is_well_formed():
+            reason = "transacción mal formada"
+        elif not signatures.owns(transaction.public_key, transaction.sender):
+            reason = "la clave pública no corresponde a la cuenta"
+        elif not self.verify_signatures([transaction])[0]:
+            reason = "firma inválida"
+        else:
+            txid, reason = self.mempool.add(transaction, self.nonces.get(transaction.sender, 0), self.balances.get(transaction.sender, 0))
+        if txid is None:
+            print(f"Transacción de {transaction.sender} a {transaction.recipient} por la cantidad de {transaction.amount} falló: {reason}.\n")
+            return None
+        print(f"Transacción agregada: {transaction.sender} -> {transaction.recipient}: {transaction.amount} (comisión {transaction.fee})\n")
+        return txid
+
+    def add_transaction(self, sender, recipient, amount, private_key, fee=0):
+        nonce = self.mempool.next_nonce(sender, self.nonces.get(sender, 0))
+        transaction = Transaction(sender, recipient, amount, fee, nonce)
+        transaction.sign(private_key)
+        if self.accept_transaction(transaction) is None:
+            return False
+        return transaction
+
+    def mine_pending_transactions(self, miner=None):
+        template = self.pending_block(miner)
+        if template is None:
+            return None
+        template.mine_block(self.mining_workers)
+        return self.append_mined(template)
+
+    def pending_block(self, miner=None):
+        # Unmined block on our tip with the best pending transactions, or None
+        transactions = self.mempool.select(MAX_BLOCK_TRANSACTIONS, self.nonces)
+        if not transactions:
             print("No hay transacciones para minar.\n") 
             return None
-        new_block = self.add_block(self.pending_transactions)
-        self.pending_transactions = []
-        return new_block
+        fees = sum(tx.fee for tx in transactions)
+        if miner is not None and fees > 0:
+            transactions.append(Transaction(FEES_SENDER, miner, fees))
+        return self.block_template(transactions)
 
-    def is_chain_valid(self, chain=None):
-        chain = chain or self.chain
-        for i in range(1, len(chain)):
-            current_block = chain[i]
-            previous_block = chain[i - 1]
-            if current_block.hash != current_block.calculate_hash():
+    def next_target(self, previous_block, window_start=None):
+        # Target the block after `previous_block` must meet. At a retarget height
+        # it is scaled by how long the last RETARGET_INTERVAL blocks took;
+        # `window_start` is the first of them, read from our chain if not given.
+        if previous_block.target is None:
+            # Genesis of an older chain, or the first block after older versions
+            return mining.difficulty_limit(self.difficulty)
+        index = previous_block.index + 1
+        if index % RETARGET_INTERVAL:
+            return previous_block.target
+        if window_start is None:
+            window_start = self.chain[index - RETARGET_INTERVAL]
+        expected = TARGET_BLOCK_SECONDS * (RETARGET_INTERVAL - 1) * 1000
+        elapsed = (previous_block.timestamp - window_start.timestamp) // datetime.timedelta(milliseconds=1)
+        elapsed = min(max(elapsed, expected // MAX_RETARGET_FACTOR), expected * MAX_RETARGET_FACTOR)
+        return max(1, min(MAX_TARGET, previous_block.target * elapsed // expected))
+
+    def window_start(self, parent):
+        # First block of the retarget window that ends with `parent`, following
+        # a side branch back to where it leaves our chain
+        block = parent
+        for _ in range(RETARGET_INTERVAL - 1):
+            entry = self.side_blocks.get(block.previous_hash)
+            if entry is None:
+                return self.chain[parent.index + 1 - RETARGET_INTERVAL]
+            block = entry[0]
+        return block
+
+    def check_blocks(self, blocks):
+        if self.validation_workers <= 1 or len(blocks) < MIN_PARALLEL_BLOCKS:
+            return check_block_chunk(blocks)
+        if self.validation_pool is None:
+            self.validation_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.validation_workers)
+        # A few chunks per worker so a slow chunk does not hold the others up
+        size = max(1, -(-len(blocks) // (self.validation_workers * 4)))
+        chunks = [blocks[start:start + size] for start in range(0, len(blocks), size)]
+        return [result for chunk in self.validation_pool.map(check_block_chunk, chunks) for result in chunk]
+
+    def shutdown_workers(self):
+        self.verifier.shutdown()
+        if self.validation_pool is not None:
+            self.validation_pool.shutdown(cancel_futures=True)
+            self.validation_pool = None
+
+    def account_state(self, fork_point):
+        # Balances and nonces just before block `fork_point` of our chain
+        if fork_point == 0:
+            return AccountState(0, {}, {})
+        if fork_point >= len(self.chain):
+            return AccountState(fork_point, self.balances, self.nonces)
+        oldest = self.conn.execute('SELECT MIN(block_index) FROM balance_undo').fetchone()[0]
+        if oldest is not None and oldest <= fork_point:
+            # Newest first, so each account ends with its state before the fork
+            changes = {}
+            for account, amount, nonce in self.conn.execute('SELECT account, previous_amount, previous_nonce FROM balance_undo WHERE block_index >= ? ORDER BY block_index DESC',
+                                                            (fork_point,)):
+                changes[account] = (amount or 0, nonce or 0)
+            return AccountState(fork_point, self.balances, self.nonces, changes)
+        # The undo history does not reach that far back, so replay up to the fork
+        accounts = {account: (amount, nonce) for account, amount, nonce in self.conn.execute('SELECT account, amount, nonce FROM snapshot_accounts')}
+        for block in self.chain.iter_from(self.snapshot_height + 1, fork_point):
+            deltas, nonces = self.balance_deltas(block.transactions)
+            for account, delta in deltas.items():
+                amount, nonce = accounts.get(account, (0, 0))
+                accounts[account] = (amount + delta, max(nonce, nonces.get(account, 0)))
+        return AccountState(fork_point, {}, {}, accounts)
+
+    def validate_blocks(self, previous_block, blocks, accounts=None):
+        # The last RETARGET_INTERVAL blocks seen, since blocks of a received
+        # suffix are not in our chain yet when the next target is computed.
+        # With `accounts`, blocks from `accounts.start` on are also applied to
+        # it, which checks their balances, nonces and size.
+        recent = collections.deque([previous_block], maxlen=RETARGET_INTERVAL)
+        latest_allowed = utc_now() + datetime.timedelta(seconds=MAX_FUTURE_SECONDS)
+        blocks = iter(blocks)
+        while True:
+            window = list(itertools.islice(blocks, VALIDATION_WINDOW))
+            if not window:
+                return True
+            if not all(self.check_blocks(window)):
+                return False
+            for current_block in window:
+                if current_block.index != previous_block.index + 1:
+                    return False
+                if current_block.previous_hash != previous_block.hash:
+                    return False
+                # Versions never go back, and blocks without a target (no proof
+                # of work to check) are only accepted as our checkpointed history
+                if current_block.version < previous_block.version:
+                    return False
+                if previous_block.version >= TARGET_BLOCK_VERSION and current_block.version < BLOCK_VERSION:
+                    return False
+                if current_block.version < TARGET_BLOCK_VERSION and not self.is_checkpointed(current_block):
+                    return False
+                if current_block.version >= TARGET_BLOCK_VERSION:
+                    window_start = recent[0] if recent[0].index == current_block.index - RETARGET_INTERVAL else None
+                    if current_block.target != self.next_target(previous_block, window_start):
+                        return False
+                    if not previous_block.timestamp <= current_block.timestamp <= latest_allowed:
+                        return False
+                if accounts is not None and current_block.index >= accounts.start and not accounts.apply(current_block):
+                    return False
+                recent.append(current_block)
+                previous_block = current_block
+
+    def is_checkpointed(self, block):
+        return block.index <= self.validated_height and self.chain[block.index].hash == block.hash
+
+    def trusted_height(self, chain):
+        # Blocks up to the checkpoint only need to be checked again if the chain
+        # no longer contains the checkpointed block
+        if len(chain) > self.validated_height and chain[self.validated_height].hash == self.validated_hash:
+            return self.validated_height
+        return 0
+
+    def find_fork_point(self, chain):
+        # Index of the first block that differs from our chain. Hashes commit to
+        # the previous block, so a shared hash means a shared prefix.
+        low, high = 0, min(len(chain), len(self.chain))
+        while low < high:
+            middle = (low + high) // 2
+            if chain[middle].hash == self.chain[middle].hash:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    @metrics.timed(FORK_VALIDATION_SECONDS)
+    def validate_fork(self, fork_point, suffix):
+        # Our own blocks between the checkpoint and the fork point, then the new suffix
+        start = min(fork_point, self.trusted_height(self.chain) + 1)
+        accounts = self.account_state(fork_point)
+        if start == 0:
+            # A whole new chain. Its genesis block is not mined, so it must
+            # start from the same target as ours; it funds the first accounts.
+            if suffix[0].target not in (None, mining.difficulty_limit(self.difficulty)):
                 return False
-            if current_block.previous_hash != previous_block.hash:
+            accounts.apply(suffix[0])
+            valid = self.validate_blocks(suffix[0], suffix[1:], accounts)
+        else:
+            blocks = itertools.chain(self.chain.iter_from(start, fork_point), suffix)
+            valid = self.validate_blocks(self.chain[start - 1], blocks, accounts)
+        return valid and self.check_transactions(suffix)
+
+    @metrics.timed(VALIDATION_SECONDS)
+    def is_chain_valid(self, chain=None):
+        if chain is None:
+            start = self.trusted_height(self.chain) + 1
+            if not self.validate_blocks(self.chain[start - 1], self.chain.iter_from(start)):
                 return False
-        return True
+            if self.validated_hash != self.chain[-1].hash:
+                self.save_checkpoint(len(self.chain) - 1, self.chain[-1].hash)
+            return True
+        fork_point = self.find_fork_point(chain)
+        return self.validate_fork(fork_point, chain[fork_point:])
 
-    def replace_chain(self, new_chain):
-        if len(new_chain) > len(self.chain) and self.is_chain_valid(new_chain):
-            self.chain = new_chain
+    def replace_chain(self, fork_point, suffix):
+        # Replaces our blocks from `fork_point` on with `suffix` if the result
+        # has more cumulative work and is valid. Our own copy of the shared
+        # prefix is kept.
+        if not suffix or fork_point > len(self.chain) or fork_point <= self.snapshot_height:
+            return False
+        more_work = self.work_before(fork_point) + sum(block.work() for block in suffix) > self.chain_work()
+        if more_work and self.validate_fork(fork_point, suffix):
+            removed = signed_spends(self.chain.iter_from(fork_point))
             with self.conn:
-                self.conn.execute('DELETE FROM blocks')
-                for block in new_chain:
-                    self.add_block_to_db(block)
-            self.balances = self.load_balances()
+                restored = self.rollback_balances(fork_point)
+                self.conn.execute('DELETE FROM blocks WHERE block_index >= ?', (fork_point,))
+                self.conn.execute('DELETE FROM tx_index WHERE block_index >= ?', (fork_point,))
+                self.conn.execute('DELETE FROM address_tx WHERE block_index >= ?', (fork_point,))
+                self.conn.execute('DELETE FROM chain_work WHERE block_index >= ?', (fork_point,))
+                changes = self.store_blocks(suffix)
+            self.chain.truncate(fork_point)
+            for block in suffix:
+                self.chain.append(block)
+            self.save_checkpoint(len(self.chain) - 1, self.chain[-1].hash)
+            if restored is None:
+                self.rebuild_balances()
+                self.balances = self.load_balances()
+                changed = None
+            else:
+                self.apply_account_changes(restored)
+                self.apply_account_changes(changes)
+                changed = restored.keys() | changes.keys()
+            for block in suffix:
+                self.mempool.remove_confirmed(block.transactions, self.nonces)
+            # Transactions of the blocks we dropped go back to the mempool if
+            # they are still valid on the new chain; the ones it already
+            # confirmed fail the nonce check
+            for tx in removed:
+                if signatures.owns(tx.public_key, tx.sender):
+                    self.mempool.add(tx, self.nonces.get(tx.sender, 0), self.balances.get(tx.sender, 0))
+            self.publish_state(changed)
             return True
         return False
 
+    def index_of(self, block_hash):
+        row = self.conn.execute('SELECT block_index FROM blocks WHERE hash = ?', (block_hash,)).fetchone()
+        return row[0] if row else None
+
+    def block_locator(self):
+        # Hashes of the last ten blocks, then exponentially further apart down
+        # to genesis, so a peer can find the fork point in one round trip
+        locator = []
+        index = len(self.chain) - 1
+        step = 1
+        while index > 0:
+            locator.append(self.chain[index].hash)
+            if len(locator) >= 10:
+                step *= 2
+            index -= step
+        locator.append(self.chain[0].hash)
+        return locator
+
+    def headers_after(self, locator, limit):
+        start = 0
+        for block_hash in locator:
+            index = self.index_of(block_hash)
+            if index is not None:
+                start = index + 1
+                break
+        return [block.header() for block in self.chain.iter_from(start, start + limit)]
+
+    def get_block_by_hash(self, block_hash):
+        index = self.index_of(block_hash)
+        return None if index is None else self.chain[index]
+
+    def locate_transaction(self, tx_hash):
+        # (block_index, position) of the newest copy of a transaction
+        row = self.conn.execute('SELECT block_index, position FROM tx_index WHERE tx_hash = ? ORDER BY block_index DESC LIMIT 1',
+                                (bytes.fromhex(tx_hash),)).fetchone()
+        return tuple(row) if row else None
+
+    def get_transaction(self, tx_hash):
+        location = self.locate_transaction(tx_hash)
+        if location is None:
+            return None
+        block = self.chain[location[0]]
+        return {
+            'hash': tx_hash,
+            'block_index': block.index,
+            'block_hash': block.hash,
+            'position': location[1],
+            'transaction': block.transactions[location[1]].to_dict()
+        }
+
+    def get_account_history(self, account, limit=50, before=None):
+        # Newest first. `before` is the cursor returned with the previous page;
+        # the returned cursor is None once there is nothing older.
+        if before is None:
+            rows = self.conn.execute('SELECT block_index, position FROM address_tx WHERE account = ? ORDER BY block_index DESC, position DESC LIMIT ?',
+                                     (account, limit)).fetchall()
+        else:
+            rows = self.conn.execute('''SELECT block_index, position FROM address_tx
+                                        WHERE account = ? AND (block_index, position) < (?, ?)
+                                        ORDER BY block_index DESC, position DESC LIMIT ?''',
+                                     (account, before[0], before[1], limit)).fetchall()
+        history = []
+        for block_index, position in rows:
+            tx = self.chain[block_index].transactions[position]
+            history.append({'hash': tx.hash(), 'block_index': block_index, 'position': position, 'transaction': tx.to_dict()})
+        cursor = tuple(rows[-1]) if len(rows) == limit else None
+        return history, cursor
+
+    def get_blocks_by_hash(self, hashes):
+        blocks = []
+        for block_hash in hashes:
+            index = self.index_of(block_hash)
+            if index is not None and index > self.snapshot_height:
+                blocks.extend(self.chain.iter_from(index, index + 1))
+        return blocks
+
+    def export_snapshot(self, path):
+        # Account state at the current tip plus every header up to it. Returns
+        # the state hash, which whoever imports the snapshot should check.
+        tip = self.chain[-1]
+        return snapshot.write(
+            path,
+            tip.index,
+            tip.hash,
+            self.chain.iter_from(0),
+            self.conn.execute('SELECT account, amount, nonce FROM balances ORDER BY account')
+        )
+
+    def import_snapshot(self, path, expected_hash=None):
+        # Replaces a fresh database with the snapshot; blocks after it are then
+        # synced as usual. Everything is written in one transaction, so a
+        # snapshot that fails any check leaves the database untouched.
+        if len(self.chain) > 1:
+            print("Solo se puede importar un snapshot en una base de datos nueva.\n")
+            return False
+        try:
+            with self.conn:
+                for table in ('blocks', 'balances', 'balance_undo', 'tx_index', 'address_tx', 'snapshot_accounts', 'chain_work'):
+                    self.conn.execute(f'DELETE FROM {table}')
+                previous = None
+                block_rows, account_rows, work_rows = [], [], []
+                work = 0
+                for kind, value in snapshot.read(path):
+                    if kind == 'meta':
+                        meta = value
+                    elif kind in ('header', 'block'):
+                        block = Block.from_dict(value) if kind == 'block' else Block.from_header(value)
+                        linked = block.index == 0 if previous is None else (block.index == previous.index + 1 and block.previous_hash == previous.hash)
+                        if not linked or block.hash != block.calculate_hash() or not block.has_valid_work():
+                            raise snapshot.SnapshotError(f"Cabecera inválida en el bloque {block.index}")
+                        block_rows.append(storage.block_row(block) if kind == 'block' else storage.header_row(block))
+                        work += block.work()
+                        work_rows.append((block.index, format(work, 'x')))
+                        previous = block
+                    elif kind == 'account':
+                        account_rows.append(tuple(value))
+                    elif kind == 'state_hash' and expected_hash is not None and value != expected_hash:
+                        raise snapshot.SnapshotError("El hash de estado no es el esperado")
+                    if len(block_rows) >= 500:
+                        self.conn.executemany(storage.INSERT_BLOCK, block_rows)
+                        self.conn.executemany(storage.INSERT_CHAIN_WORK, work_rows)
+                        block_rows, work_rows = [], []
+                    if len(account_rows) >= 500:
+                        self.conn.executemany(storage.UPSERT_BALANCE, account_rows)
+                        self.conn.executemany('INSERT INTO snapshot_accounts (account, amount, nonce) VALUES (?, ?, ?)', account_rows)
+                        account_rows = []
+                if previous is None or previous.index != meta['height'] or previous.hash != meta['block_hash']:
+                    raise snapshot.SnapshotError("Las cabeceras no terminan en el bloque del snapshot")
+                self.conn.executemany(storage.INSERT_BLOCK, block_rows)
+                self.conn.executemany(storage.INSERT_CHAIN_WORK, work_rows)
+                self.conn.executemany(storage.UPSERT_BALANCE, account_rows)
+                self.conn.executemany('INSERT INTO snapshot_accounts (account, amount, nonce) VALUES (?, ?, ?)', account_rows)
+                for key in ('balances_height', 'tx_index_height', 'chain_work_height', 'snapshot_height'):
+                    self.set_state(key, meta['height'])
+        except (snapshot.SnapshotError, OSError, ValueError, KeyError, TypeError) as e:
+            print(f"No se pudo importar el snapshot: {e}\n")
+            return False
+        self.snapshot_height = meta['height']
+        self.chain.reload()
+        self.save_checkpoint(previous.index, previous.hash)
+        self.balances = self.load_balances()
+        self.publish_state()
+        print(f"Snapshot importado hasta el bloque {previous.index}\n")
+        return True
+
+    def get_transaction_proof(self, tx_hash, block_index=None):
+        if block_index is None:
+            location = self.locate_transaction(tx_hash)
+            if location is None:
+                return None
+            block_index = location[0]
+        block = self.chain[block_index]
+        if block.version == LEGACY_BLOCK_VERSION:
+            return None
+        encoded_transactions = [tx.encode(block.version) for tx in block.transactions]
+        for position, tx in enumerate(block.transactions):
+            if tx.hash() == tx_hash:
+                return {
+                    'transaction': tx.to_dict(),
+                    'position': position,
+                    'proof': [[side, sibling.hex()] for side, sibling in merkle.merkle_proof(encoded_transactions, position)],
+                    'header': block.header()
+                }
+        return None
+
+    @staticmethod
+    def verify_transaction_proof(transaction, proof):
+        # Only checks the proof against the header; the caller must know the
+        # header is part of its chain
+        header = proof['header']
+        if header['version'] == LEGACY_BLOCK_VERSION or not Block.verify_header(header):
+            return False
+        branch = [(side, bytes.fromhex(sibling)) for side, sibling in proof['proof']]
+        return merkle.verify_proof(transaction.encode(header['version']), branch, bytes.fromhex(header['merkle_root']))
+
     def get_balance(self, node_id):
-        print(self.balances)
-        return self.balances.get(node_id, 0)
+        # Safe from any thread
+        return self.published.balance(node_id)
+
+
+
+# Implementación
+
 
+if __name__ == "__main__":
+    import sys
 
+    usage = ("Uso: python blockchain.py <rebuild|verify> [ruta_db]\n"
+             "     python blockchain.py export-snapshot <archivo> [ruta_db]\n"
+             "     python blockchain.py import-snapshot <archivo> <hash_estado> [ruta_db]")
+    arguments = {'rebuild': 0, 'verify': 0, 'export-snapshot': 1, 'import-snapshot': 2}
+    if len(sys.argv) < 2 or sys.argv[1] not in arguments or len(sys.argv) - 2 - arguments[sys.argv[1]] not in (0, 1):
+        print(usage)
+        sys.exit(1)
 
-# Implementación 
+    command, parameters = sys.argv[1], sys.argv[2:2 + arguments[sys.argv[1]]]
+    blockchain = Blockchain(db_path=sys.argv[-1] if len(sys.argv) == 3 + arguments[command] else 'blockchain.db')
+    if command == 'export-snapshot':
+        state_hash = blockchain.export_snapshot(parameters[0])
+        print(f"Snapshot del bloque {blockchain.chain[-1].index} guardado en {parameters[0]}")
+        print(f"Hash de estado: {state_hash}")
+    elif command == 'import-snapshot':
+        sys.exit(0 if blockchain.import_snapshot(parameters[0], parameters[1]) else 1)
+    elif command == 'rebuild':
+        balances = blockchain.rebuild_balances()
+        print(f"Saldos reconstruidos: {len(balances)} cuentas hasta el bloque {blockchain.chain[-1].index}")
+    else:
+        chain_ok = blockchain.validate_blocks(blockchain.chain[0], blockchain.chain.iter_from(1))
+        balances_ok = blockchain.verify_balances()
+        print(f"Cadena {'válida' if chain_ok else 'inválida'}, saldos {'correctos' if balances_ok else 'incorrectos'}")
+        sys.exit(0 if chain_ok and balances_ok else 1)
@@ -0,0 +1,82 @@
+import collections
+
+
+class OrphanPool:
+    # Blocks whose parent has not arrived yet, grouped by the parent's hash.
+    # When full, the blocks that have waited longest are dropped.
+
+    def __init__(self, max_blocks=100):
+        self.max_blocks = max_blocks
+        self.blocks = collections.OrderedDict()
+        self.by_parent = collections.defaultdict(set)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.blocks
+
+    def add(self, block):
+        if block.hash in self.blocks:
+            return False
+        self.blocks[block.hash] = block
+        self.by_parent[block.previous_hash].add(block.hash)
+        while len(self.blocks) > self.max_blocks:
+            _, oldest = self.blocks.popitem(last=False)
+            self.forget(oldest)
+        return True
+
+    def forget(self, block):
+        children = self.by_parent.get(block.previous_hash)
+        if children is not None:
+            children.discard(block.hash)
+            if not children:
+                del self.by_parent[block.previous_hash]
+
+    def pop_children(self, parent_hash):
+        return [self.blocks.pop(block_hash) for block_hash in self.by_parent.pop(parent_hash, ())]
+
+
+class BlockTree:
+    # Blocks on branches other than the main chain, whose parent is known, each
+    # with the cumulative work of the chain it ends. The main chain itself stays
+    # in the database; only what could still win a reorg is kept here.
+
+    def __init__(self, max_blocks=1000):
+        self.max_blocks = max_blocks
+        self.blocks = {}
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.blocks
+
+    def get(self, block_hash):
+        # (block, cumulative work) or None
+        return self.blocks.get(block_hash)
+
+    def add(self, block, work):
+        self.blocks[block.hash] = (block, work)
+        if len(self.blocks) > self.max_blocks:
+            # Lowest blocks first, they are the least likely to matter
+            for block_hash, _ in sorted(self.blocks.items(), key=lambda item: item[1][0].index)[:len(self.blocks) - self.max_blocks]:
+                del self.blocks[block_hash]
+
+    def remove(self, block_hashes):
+        for block_hash in block_hashes:
+            self.blocks.pop(block_hash, None)
+
+    def branch(self, block_hash):
+        # Blocks from the first one off the main chain up to `block_hash`
+        blocks = []
+        entry = self.blocks.get(block_hash)
+        while entry is not None:
+            blocks.append(entry[0])
+            entry = self.blocks.get(entry[0].previous_hash)
+        blocks.reverse()
+        return blocks
+
+    def prune(self, min_index):
+        for block_hash in [block_hash for block_hash, (block, _) in self.blocks.items() if block.index < min_index]:
+            del self.blocks[block_hash]
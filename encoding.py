@@ -0,0 +1,132 @@
+import datetime
+import struct
+
+# Compact binary encoding used as the hash preimage of version 2+ blocks.
+# Integers are little-endian, variable length fields carry a varint length.
+
+EPOCH = datetime.datetime(1970, 1, 1)
+GENESIS_PREVIOUS_HASH = '0'
+
+_HEADER = struct.Struct('<IQq')
+_AMOUNT = struct.Struct('<d')
+_NONCE = struct.Struct('<Q')
+
+
+def encode_varint(value):
+    if value < 0:
+        raise ValueError("Un varint no puede ser negativo")
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(buf, offset=0):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_bytes(data):
+    return encode_varint(len(data)) + data
+
+
+def decode_bytes(buf, offset=0):
+    length, offset = decode_varint(buf, offset)
+    end = offset + length
+    if end > len(buf):
+        raise ValueError("Datos truncados")
+    return bytes(buf[offset:end]), end
+
+
+def encode_str(text):
+    return encode_bytes(text.encode('utf-8'))
+
+
+def decode_str(buf, offset=0):
+    data, offset = decode_bytes(buf, offset)
+    return data.decode('utf-8'), offset
+
+
+def encode_amount(amount):
+    return _AMOUNT.pack(float(amount))
+
+
+def decode_amount(buf, offset=0):
+    return _AMOUNT.unpack_from(buf, offset)[0], offset + _AMOUNT.size
+
+
+def encode_nonce(nonce):
+    return _NONCE.pack(nonce)
+
+
+def encode_legacy_nonce(nonce):
+    return str(nonce).encode('utf-8')
+
+
+def timestamp_to_micros(timestamp):
+    return (timestamp - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def micros_to_timestamp(micros):
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def hash_to_bytes(block_hash):
+    if block_hash == GENESIS_PREVIOUS_HASH:
+        return bytes(32)
+    data = bytes.fromhex(block_hash)
+    if len(data) != 32:
+        raise ValueError(f"Hash inválido: {block_hash}")
+    return data
+
+
+def encode_transaction(sender, recipient, amount):
+    return encode_str(sender) + encode_str(recipient) + encode_amount(amount)
+
+
+def decode_transaction(buf, offset=0):
+    sender, offset = decode_str(buf, offset)
+    recipient, offset = decode_str(buf, offset)
+    amount, offset = decode_amount(buf, offset)
+    return (sender, recipient, amount), offset
+
+
+def encode_transaction_list(encoded_transactions):
+    return encode_varint(len(encoded_transactions)) + b''.join(encode_bytes(tx) for tx in encoded_transactions)
+
+
+def decode_transaction_list(buf, offset=0):
+    count, offset = decode_varint(buf, offset)
+    encoded_transactions = []
+    for _ in range(count):
+        tx, offset = decode_bytes(buf, offset)
+        encoded_transactions.append(tx)
+    return encoded_transactions, offset
+
+
+def encode_target(target):
+    return target.to_bytes(32, 'big')
+
+
+def encode_header_prefix(version, index, timestamp, previous_hash, merkle_root, target=None):
+    # Blocks that record their proof of work target commit to it right before the nonce
+    prefix = (
+        _HEADER.pack(version, index, timestamp_to_micros(timestamp)) +
+        hash_to_bytes(previous_hash) +
+        merkle_root
+    )
+    if target is not None:
+        prefix += encode_target(target)
+    return prefix
@@ -0,0 +1,142 @@
+import heapq
+import itertools
+import time
+
+
+class MempoolEntry:
+    def __init__(self, transaction, txid, sequence):
+        self.transaction = transaction
+        self.txid = txid
+        self.size = len(transaction.encode())
+        self.fee_rate = transaction.fee / self.size
+        self.added = time.monotonic()
+        self.sequence = sequence
+
+
+class Mempool:
+    # Pending transactions indexed by id and by (sender, nonce). Memory is
+    # bounded by count, encoded size and age; when full, the lowest fee rate
+    # entries are evicted first.
+
+    def __init__(self, max_transactions=5000, max_bytes=1024 * 1024, max_age=3600):
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries = {}
+        self.by_sender = {}
+        self.total_bytes = 0
+        # Min-heap of (fee_rate, sequence, txid) for eviction. Removed entries
+        # stay in it until they reach the top.
+        self.eviction_heap = []
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    def __iter__(self):
+        return (entry.transaction for entry in self.entries.values())
+
+    def pending_spend(self, sender):
+        return sum(self.entries[txid].transaction.amount + self.entries[txid].transaction.fee
+                   for txid in self.by_sender.get(sender, {}).values())
+
+    def next_nonce(self, sender, account_nonce):
+        nonces = self.by_sender.get(sender)
+        if not nonces:
+            return account_nonce
+        return max(account_nonce, max(nonces) + 1)
+
+    def add(self, transaction, account_nonce, balance):
+        # Returns (txid, None) when added, (None, reason) when rejected
+        txid = transaction.hash()
+        if txid in self.entries:
+            return None, "transacción duplicada"
+        # Written so that NaN fails too
+        if not (transaction.amount > 0 and transaction.fee >= 0):
+            return None, "cantidad inválida"
+        if transaction.nonce < account_nonce:
+            return None, "nonce ya usado"
+
+        replaced = self.by_sender.get(transaction.sender, {}).get(transaction.nonce)
+        spend = self.pending_spend(transaction.sender)
+        if replaced is not None:
+            # Same sender and nonce: only a higher fee may replace the pending one
+            old = self.entries[replaced].transaction
+            if transaction.fee <= old.fee:
+                return None, "ya hay una transacción con ese nonce"
+            spend -= old.amount + old.fee
+        if balance is not None and spend + transaction.amount + transaction.fee > balance:
+            return None, "no hay saldo suficiente"
+
+        if replaced is not None:
+            self.remove(replaced)
+        entry = MempoolEntry(transaction, txid, next(self.sequence))
+        self.entries[txid] = entry
+        self.by_sender.setdefault(transaction.sender, {})[transaction.nonce] = txid
+        self.total_bytes += entry.size
+        heapq.heappush(self.eviction_heap, (entry.fee_rate, entry.sequence, txid))
+        self.evict()
+        if txid not in self.entries:
+            return None, "la mempool está llena"
+        return txid, None
+
+    def remove(self, txid):
+        entry = self.entries.pop(txid, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry.size
+        nonces = self.by_sender[entry.transaction.sender]
+        del nonces[entry.transaction.nonce]
+        if not nonces:
+            del self.by_sender[entry.transaction.sender]
+
+    def remove_confirmed(self, transactions, account_nonces):
+        # Drops mined transactions and anything their senders can no longer use
+        for tx in transactions:
+            self.remove(tx.hash())
+        for sender in {tx.sender for tx in transactions}:
+            for nonce, txid in list(self.by_sender.get(sender, {}).items()):
+                if nonce < account_nonces.get(sender, 0):
+                    self.remove(txid)
+
+    def evict(self):
+        # Entries are kept in arrival order, so expired ones are all at the front
+        now = time.monotonic()
+        expired = []
+        for txid, entry in self.entries.items():
+            if now - entry.added <= self.max_age:
+                break
+            expired.append(txid)
+        for txid in expired:
+            self.remove(txid)
+        while (len(self.entries) > self.max_transactions or self.total_bytes > self.max_bytes) and self.eviction_heap:
+            _, sequence, txid = heapq.heappop(self.eviction_heap)
+            entry = self.entries.get(txid)
+            if entry is not None and entry.sequence == sequence:
+                self.remove(txid)
+        if len(self.eviction_heap) > 2 * len(self.entries) + 64:
+            self.eviction_heap = [(entry.fee_rate, entry.sequence, entry.txid) for entry in self.entries.values()]
+            heapq.heapify(self.eviction_heap)
+
+    def select(self, max_transactions, account_nonces):
+        # Block template: highest fee rate first, but each sender's transactions
+        # only in nonce order starting at the sender's next nonce on chain
+        ready = []
+        for sender, nonces in self.by_sender.items():
+            txid = nonces.get(account_nonces.get(sender, 0))
+            if txid is not None:
+                entry = self.entries[txid]
+                heapq.heappush(ready, (-entry.fee_rate, entry.sequence, txid))
+        selected = []
+        while ready and len(selected) < max_transactions:
+            _, _, txid = heapq.heappop(ready)
+            transaction = self.entries[txid].transaction
+            selected.append(transaction)
+            following = self.by_sender[transaction.sender].get(transaction.nonce + 1)
+            if following is not None:
+                entry = self.entries[following]
+                heapq.heappush(ready, (-entry.fee_rate, entry.sequence, following))
+        return selected
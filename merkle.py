@@ -0,0 +1,59 @@
+import hashlib
+
+# Leaves and inner nodes are hashed with different prefixes so an inner node
+# can never be passed off as a transaction.
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+EMPTY_ROOT = hashlib.sha256(b'').digest()
+
+
+def hash_leaf(data):
+    return hashlib.sha256(LEAF_PREFIX + data).digest()
+
+
+def hash_node(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def next_level(level):
+    # An odd node at the end of a level is promoted unchanged
+    parents = [hash_node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+
+def merkle_root(leaves):
+    if not leaves:
+        return EMPTY_ROOT
+    level = [hash_leaf(leaf) for leaf in leaves]
+    while len(level) > 1:
+        level = next_level(level)
+    return level[0]
+
+
+def merkle_proof(leaves, index):
+    # Sibling hashes from the leaf up to the root, tagged with the side they sit on
+    if not 0 <= index < len(leaves):
+        raise IndexError("Índice de hoja fuera de rango")
+    level = [hash_leaf(leaf) for leaf in leaves]
+    proof = []
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(('left' if sibling < index else 'right', level[sibling]))
+        level = next_level(level)
+        index //= 2
+    return proof
+
+
+def verify_proof(leaf, proof, root):
+    current = hash_leaf(leaf)
+    for side, sibling in proof:
+        if side == 'left':
+            current = hash_node(sibling, current)
+        elif side == 'right':
+            current = hash_node(current, sibling)
+        else:
+            return False
+    return current == root
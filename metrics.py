@@ -0,0 +1,205 @@
+import collections
+import functools
+import http.server
+import sys
+import threading
+import time
+import urllib.parse
+
+# Metrics are off until enable() is called. While off, every update returns
+# after reading this flag, so instrumented code pays for one global lookup.
+enabled = False
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+registry = {}
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        registry[name] = self
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for values, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, values)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *labels):
+        if not enabled:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        # A gauge with a function is read when scraped and costs nothing
+        # otherwise. Each set of label values can have its own function.
+        self.functions = {}
+        if function is not None:
+            self.track(function)
+
+    def set(self, value, *labels):
+        if not enabled:
+            return
+        with self.lock:
+            self.values[labels] = value
+
+    def track(self, function, *labels):
+        with self.lock:
+            self.functions[labels] = function
+
+    def untrack(self, *labels):
+        with self.lock:
+            self.functions.pop(labels, None)
+            self.values.pop(labels, None)
+
+    def render(self):
+        with self.lock:
+            functions = list(self.functions.items())
+        values = {labels: function() for labels, function in functions}
+        with self.lock:
+            self.values.update(values)
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        if not enabled:
+            return
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # One count per bucket, then the sum and the total count
+                counts = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for values, counts in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{format_labels(self.labels, values, [("le", bound)])} {count}')
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, values, [("le", "+Inf")])} {counts[-1]}')
+                lines.append(f'{self.name}_sum{format_labels(self.labels, values)} {counts[-2]}')
+                lines.append(f'{self.name}_count{format_labels(self.labels, values)} {counts[-1]}')
+        return lines
+
+
+def timed(histogram):
+    # Decorator recording how long each call takes in `histogram`
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def render():
+    lines = []
+    for metric in list(registry.values()):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def sample_stacks(seconds, interval=0.005):
+    # Sampling profiler: every `interval` seconds the stack of every other
+    # thread is recorded. Returns collapsed stacks ("a;b;c count"), the input
+    # format of flame graph tools. Nothing runs unless it is asked for.
+    samples = collections.Counter()
+    own = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(f'{frame.f_code.co_name} ({frame.f_code.co_filename.rsplit("/", 1)[-1]}:{frame.f_code.co_firstlineno})')
+                frame = frame.f_back
+            samples[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return ''.join(f'{stack} {count}\n' for stack, count in samples.most_common())
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == '/metrics':
+            body = render()
+            content_type = 'text/plain; version=0.0.4'
+        elif url.path == '/profile':
+            query = urllib.parse.parse_qs(url.query)
+            body = sample_stacks(min(float(query.get('seconds', ['5'])[0]), 60))
+            content_type = 'text/plain'
+        else:
+            self.send_error(404)
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1'):
+    # Enables metrics and serves /metrics (Prometheus text format) and
+    # /profile?seconds=N (sampling profiler) from a background thread
+    enable()
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,93 @@
+import hashlib
+import multiprocessing
+import queue
+
+CHUNK_SIZE = 50000
+
+
+def difficulty_limit(difficulty):
+    # A hash with `difficulty` leading hex zeros is a number below this limit
+    return 1 << (256 - 4 * difficulty)
+
+
+def target_bound(target):
+    # Largest digest that meets `target`, as 32 big-endian bytes. Digests of the
+    # same length compare as bytes exactly as they do as numbers.
+    return (min(max(target, 1), 1 << 256) - 1).to_bytes(32, 'big')
+
+
+def meets_target(block_hash, target):
+    return int(block_hash, 16) < target
+
+
+def target_work(target):
+    # Expected number of hashes to find one below `target`
+    return (1 << 256) // (target + 1)
+
+
+def search_nonces(prefix, target, start, stop, encode_nonce):
+    # The nonce is the last field of the preimage, so the SHA-256 state of the
+    # fixed prefix is computed once and copied for every candidate.
+    midstate = hashlib.sha256(prefix)
+    bound = target_bound(target)
+    for nonce in range(start, stop):
+        sha = midstate.copy()
+        sha.update(encode_nonce(nonce))
+        digest = sha.digest()
+        if digest <= bound:
+            return nonce, digest.hex()
+    return None
+
+
+def mine(prefix, target, encode_nonce, start=0, stop=None):
+    # `stop` is checked between chunks; None is returned once it says so
+    while stop is None or not stop():
+        result = search_nonces(prefix, target, start, start + CHUNK_SIZE, encode_nonce)
+        if result:
+            return result
+        start += CHUNK_SIZE
+    return None
+
+
+def _mine_worker(prefix, target, encode_nonce, start, worker_id, workers, found, results):
+    # Worker i scans chunks i, i + workers, i + 2 * workers, ... so the ranges never overlap
+    chunk_start = start + worker_id * CHUNK_SIZE
+    while not found.is_set():
+        result = search_nonces(prefix, target, chunk_start, chunk_start + CHUNK_SIZE, encode_nonce)
+        if result:
+            found.set()
+            results.put(result)
+            return
+        chunk_start += workers * CHUNK_SIZE
+
+
+def mine_parallel(prefix, target, encode_nonce, workers, start=0, stop=None):
+    if workers <= 1:
+        return mine(prefix, target, encode_nonce, start, stop)
+
+    ctx = multiprocessing.get_context()
+    found = ctx.Event()
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=_mine_worker, args=(prefix, target, encode_nonce, start, i, workers, found, results), daemon=True)
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        while True:
+            try:
+                return results.get(timeout=0.1)
+            except queue.Empty:
+                if stop is not None and stop():
+                    return None
+                if not any(process.is_alive() for process in processes):
+                    raise RuntimeError("Todos los procesos de minado terminaron sin encontrar un nonce")
+    finally:
+        # Cancel the remaining workers as soon as one of them has a solution
+        found.set()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
@@ -1,233 +1,634 @@
-import socket
+import asyncio
+import concurrent.futures
+import hashlib
 import threading
-import json
+import time
 import sys
-from blockchain import Blockchain, Block, Transaction
-from PyQt6.QtCore import pyqtSignal, QObject
+import metrics
+import protocol
+import signatures
+from seen import SeenCache
+from sync import ChainSync
+from blockchain import Blockchain, Block, Transaction, signed_spends
 
 print_lock = threading.Lock()
 
+MESSAGES = metrics.Counter('node_messages_total', 'Mensajes recibidos por tipo', ('type',))
+DUPLICATE_MESSAGES = metrics.Counter('node_duplicate_messages_total', 'Mensajes de difusión ya vistos y descartados', ('type',))
+MESSAGE_SECONDS = metrics.Histogram('node_message_seconds', 'Tiempo desde que se lee un mensaje hasta que se termina de procesar', ('type',))
+# Labelled with the node's port, since several nodes can share a process
+PEERS = metrics.Gauge('node_peers', 'Peers conocidos', ('node',))
+MEMPOOL_TRANSACTIONS = metrics.Gauge('node_mempool_transactions', 'Transacciones en la mempool', ('node',))
+MEMPOOL_BYTES = metrics.Gauge('node_mempool_bytes', 'Tamaño codificado de la mempool', ('node',))
+CHAIN_HEIGHT = metrics.Gauge('node_chain_height', 'Altura de la cadena', ('node',))
+NODE_GAUGES = (PEERS, MEMPOOL_TRANSACTIONS, MEMPOOL_BYTES, CHAIN_HEIGHT)
+
 def safe_print(*args, **kwargs):
     with print_lock:
         print(*args, **kwargs)
 
-class Node(QObject):
-    message_received = pyqtSignal(str)  # Signal to emit when a message is received
+class PeerLink:
+    # Outbound side of one peer: a bounded queue of encoded frames drained by a
+    # single writer task over a long-lived connection. A slow or dead peer only
+    # fills its own queue.
+    QUEUE_SIZE = 256
+    BASE_BACKOFF = 0.5
+    MAX_BACKOFF = 30
+    MAX_FAILURES = 5
+
+    def __init__(self, node, address):
+        self.node = node
+        self.address = address
+        self.queue = asyncio.Queue(self.QUEUE_SIZE)
+        self.writer = None
+        self.failures = 0
+        self.task = asyncio.create_task(self.run())
 
-    def __init__(self, host, port, db_path='blockchain.db'):
+    async def connect(self):
+        if self.writer is None or self.writer.is_closing():
+            _, self.writer = await asyncio.wait_for(asyncio.open_connection(*self.address), timeout=5)
+        return self.writer
+
+    async def put(self, frame, timeout=5):
+        try:
+            await asyncio.wait_for(self.queue.put(frame), timeout)
+            return True
+        except asyncio.TimeoutError:
+            safe_print(f"Cola de envío a {self.address} llena, mensaje descartado")
+            return False
+
+    async def run(self):
+        while True:
+            frame = await self.queue.get()
+            while True:
+                try:
+                    writer = await self.connect()
+                    writer.write(frame)
+                    await writer.drain()
+                    self.failures = 0
+                    break
+                except (OSError, asyncio.TimeoutError) as e:
+                    self.close()
+                    self.failures += 1
+                    if self.failures >= self.MAX_FAILURES:
+                        self.node.drop_peer(self.address, e)
+                        return
+                    await asyncio.sleep(min(self.MAX_BACKOFF, self.BASE_BACKOFF * 2 ** self.failures))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+class Node:
+    # Incoming transactions are verified in batches of up to this many, waiting
+    # at most TRANSACTION_BATCH_DELAY seconds for a batch to fill
+    TRANSACTION_BATCH_SIZE = 256
+    TRANSACTION_BATCH_DELAY = 0.05
+    # Mempool transactions included in status()
+    STATUS_TRANSACTIONS = 20
+
+    def __init__(self, host, port, db_path='blockchain.db', mining_workers=1, key_path=None, genesis_accounts=None):
         self.host = host
         self.port = port
-        self.node_id = str(port)
+        self.private_key = signatures.load_or_create_key(key_path or f'nodo_{port}.key')
+        # The node's account is the address of its key
+        self.node_id = signatures.address(signatures.public_key_hex(self.private_key))
         self.peers = set()
-        self.blockchain = Blockchain(db_path=db_path)
-        self.received_transactions = set()
-        self.received_blocks = set()
+        # Wire encodings each peer announced in its NEW_PEER; peers missing
+        # here only get JSON
+        self.peer_encodings = {}
+        # Messages go through three stages: frames are read and decoded on the
+        # event loop, stateless checks (hashes, proof of work, signatures) run
+        # on the default worker pool, and only then does the chain thread apply
+        # them. That one thread owns the Blockchain and its database connection,
+        # which is why it also opens them; other threads read
+        # blockchain.published.
+        self.chain_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='chain')
+        # A new database starts with a genesis block that funds this node
+        self.blockchain = self.chain_executor.submit(Blockchain, db_path=db_path, mining_workers=mining_workers,
+                                                     genesis_accounts=genesis_accounts or [self.node_id]).result()
+        # Proof of work runs on its own thread, so the chain thread keeps
+        # applying peer messages while a block is mined
+        self.mining_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='mining')
+        self.transaction_batch = []
+        self.batch_timer = None
+        # Transactions are keyed by the digest of their frame payload, blocks by
+        # their hash once it has been checked
+        self.received_transactions = SeenCache()
+        self.received_blocks = SeenCache()
+        self.sync = ChainSync(self.blockchain)
+        self.links = {}
+        self.clients = set()
+        self.loop = None
+        self.started = threading.Event()
         self.running = False
+        # Called with 'started', 'peers', 'mempool' or 'chain' from whichever
+        # node thread made the change, so they must return quickly
+        self.listeners = []
+        # Read only when the metrics endpoint is scraped
+        PEERS.track(lambda: len(self.peers), str(self.port))
+        MEMPOOL_TRANSACTIONS.track(lambda: len(self.blockchain.mempool), str(self.port))
+        MEMPOOL_BYTES.track(lambda: self.blockchain.mempool.total_bytes, str(self.port))
+        CHAIN_HEIGHT.track(lambda: self.blockchain.published.height, str(self.port))
 
     def start(self):
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.bind((self.host, self.port))
-        server.listen()
+        # Blocks the calling thread running the node's event loop
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            safe_print("Apagando el nodo...")
+        finally:
+            self.running = False
+            safe_print("Servidor cerrado.")
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
 
         self.running = True
+        self.started.set()
+        self.notify('started')
 
         safe_print(f"Nodo escuchando en {self.host}:{self.port}")
 
+        safe_print(f"Dirección del nodo: {self.node_id}")
         print("Balance " + str(self.get_balance()))
 
+        async with server:
+            await self.stop_event.wait()
+        for writer in list(self.clients):
+            writer.close()
+        for link in self.links.values():
+            link.task.cancel()
+            link.close()
+        self.blockchain.shutdown_workers()
+        for gauge in NODE_GAUGES:
+            gauge.untrack(str(self.port))
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    def call(self, coroutine, timeout=None):
+        # Runs a coroutine on the node's loop from any other thread and waits for it
+        self.started.wait()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def post(self, coroutine):
+        # Like call, without waiting: sends wait on full peer queues, which must
+        # not hold up the chain thread
+        self.started.wait()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def on_chain(self, function, *args):
+        return self.chain_executor.submit(function, *args).result()
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, *kinds):
+        for listener in self.listeners:
+            for kind in kinds:
+                listener(kind)
+
+    def status(self, kinds):
+        # Meant to run on the chain thread, where the chain and mempool cannot
+        # change while they are read
+        status = {}
+        if 'peers' in kinds:
+            status['peers'] = sorted(self.peers)
+        if 'chain' in kinds:
+            tip = self.blockchain.get_latest_block()
+            status['chain'] = {'height': tip.index, 'hash': tip.hash, 'timestamp': tip.timestamp.isoformat(), 'balance': self.get_balance()}
+        if 'mempool' in kinds:
+            mempool = self.blockchain.mempool
+            status['mempool'] = {
+                'transactions': len(mempool),
+                'bytes': mempool.total_bytes,
+                'next': [tx.to_dict() for tx in mempool.select(self.STATUS_TRANSACTIONS, self.blockchain.nonces)]
+            }
+        return status
+
+    async def handle_client(self, reader, writer):
+        # Peers keep their connection open and send any number of frames on it
+        self.clients.add(writer)
         try:
-            while self.running:
-                client, address = server.accept()
-                client_thread = threading.Thread(target=self.handle_client, args=(client,))
-                client_thread.daemon = True 
-                client_thread.start()
-        except KeyboardInterrupt:
-            safe_print("Apagando el nodo...")
+            while True:
+                frame = await protocol.read_frame_async(reader)
+                if frame is None:
+                    break
+                type_code, payload = frame
+                if type_code & protocol.TYPE_MASK == protocol.TYPE_CODES['NEW_TRANSACTION'] and not self.received_transactions.add(hashlib.sha256(payload).digest()):
+                    DUPLICATE_MESSAGES.inc(1, 'NEW_TRANSACTION')
+                    continue
+                # Our block messages start with the hash, so a block seen before
+                # is dropped without decoding the rest
+                if type_code & protocol.TYPE_MASK == protocol.TYPE_CODES['NEW_BLOCK'] and protocol.peek_hash(type_code, payload) in self.received_blocks:
+                    DUPLICATE_MESSAGES.inc(1, 'NEW_BLOCK')
+                    continue
+                try:
+                    message = protocol.decode_frame(*frame)
+                    block_hash = self.block_hash(message)
+                except protocol.ProtocolError as e:
+                    safe_print(f"Mensaje inválido recibido: {e}")
+                    continue
+                if block_hash is not None and block_hash in self.received_blocks:
+                    DUPLICATE_MESSAGES.inc(1, 'NEW_BLOCK')
+                    continue
+                if message['type'] == 'NEW_TRANSACTION':
+                    await self.queue_transaction(message)
+                    continue
+                await self.dispatch(message)
+        except (OSError, protocol.ProtocolError, asyncio.CancelledError):
+            pass
         finally:
-            self.running = False
-            server.close()
-            safe_print("Servidor cerrado.")
+            self.clients.discard(writer)
+            writer.close()
 
-    def handle_client(self, client):
-        while True:
+    @staticmethod
+    def block_hash(message):
+        # The hash of a NEW_BLOCK as bytes, None for other messages
+        if message['type'] != 'NEW_BLOCK':
+            return None
+        try:
+            return bytes.fromhex(message['hash'])
+        except (KeyError, TypeError, ValueError):
+            raise protocol.ProtocolError("Bloque sin hash válido")
+
+    async def queue_transaction(self, message):
+        self.transaction_batch.append((message, time.perf_counter()))
+        if len(self.transaction_batch) >= self.TRANSACTION_BATCH_SIZE:
+            await self.flush_transactions()
+        elif self.batch_timer is None:
+            self.batch_timer = self.loop.call_later(self.TRANSACTION_BATCH_DELAY, lambda: asyncio.ensure_future(self.flush_transactions()))
+
+    async def flush_transactions(self):
+        # Signatures of the whole batch are checked off the event loop, then
+        # the valid transactions reach the chain thread together, in one job.
+        # The results stay cached, so accepting them there does not verify
+        # them again.
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        batch, self.transaction_batch = self.transaction_batch, []
+        if not batch:
+            return
+        # Each transaction is decoded on its own, a malformed one is dropped
+        # without taking the rest of the batch with it
+        transactions = []
+        for message, _ in batch:
             try:
-                message = client.recv(1024).decode('utf-8')
-                if message:
-                    self.handle_message(json.loads(message))
-                else:
-                    break
-            except:
-                break
-        client.close()
+                transaction = Transaction.from_dict(message['transaction'])
+            except (KeyError, TypeError, AttributeError):
+                continue
+            if transaction.is_well_formed():
+                transactions.append(transaction)
+        try:
+            valid = await self.loop.run_in_executor(None, self.blockchain.verify_signatures, transactions)
+        except Exception as e:
+            safe_print(f"Error al verificar transacciones: {e}")
+            return
+        if len(batch) > valid.count(True):
+            safe_print(f"{len(batch) - valid.count(True)} transacciones recibidas mal formadas o con firma inválida")
+        signed = [transaction for transaction, ok in zip(transactions, valid) if ok]
+        try:
+            accepted = await self.loop.run_in_executor(self.chain_executor, self.handle_transactions, signed)
+        except Exception as e:
+            safe_print(f"Error al procesar transacciones: {e}")
+            accepted = []
+        # Relayed from the event loop, the chain thread does not wait for it
+        for transaction in accepted:
+            await self.broadcast_frame(self.transaction_frames(transaction))
+        now = time.perf_counter()
+        MESSAGES.inc(len(batch), 'NEW_TRANSACTION')
+        for _, received in batch:
+            MESSAGE_SECONDS.observe(now - received, 'NEW_TRANSACTION')
+
+    def handle_transactions(self, transactions):
+        # Runs on the chain thread, returns the transactions that entered the mempool
+        accepted = [transaction for transaction in transactions if self.blockchain.accept_transaction(transaction)]
+        if accepted:
+            self.notify('mempool')
+        return accepted
+
+    def prepare(self, message):
+        # Stateless checks, run on the worker pool so the chain thread only gets
+        # messages worth applying. Returns False for a message to drop.
+        if message['type'] == 'NEW_BLOCK':
+            block = Block.from_dict(message)
+            if block.hash != block.calculate_hash() or not block.has_valid_work():
+                return False
+            # Leaves the results in the verifier cache for check_transactions
+            self.blockchain.verify_signatures(signed_spends([block]))
+            message['block'] = block
+        elif message['type'] == 'BLOCKS':
+            blocks = [Block.from_dict(data) for data in message['blocks']]
+            message['blocks'] = [block for block in blocks if block.hash == block.calculate_hash()]
+            self.blockchain.verify_signatures(signed_spends(message['blocks']))
+        return True
+
+    async def dispatch(self, message, received=None):
+        # Runs the message on the chain thread; the time it waited there counts too
+        received = received or time.perf_counter()
+        try:
+            if message['type'] in ('NEW_BLOCK', 'BLOCKS') and not await self.loop.run_in_executor(None, self.prepare, message):
+                safe_print(f"Mensaje {message['type']} inválido descartado")
+            else:
+                await self.loop.run_in_executor(self.chain_executor, self.handle_message, message)
+        except Exception as e:
+            safe_print(f"Error al procesar el mensaje {message['type']}: {e}")
+        MESSAGES.inc(1, message['type'])
+        MESSAGE_SECONDS.observe(time.perf_counter() - received, message['type'])
 
     def handle_message(self, message):
         if message['type'] == 'NEW_PEER':
-            self.peers.add((message['host'], message['port']))
+            address = (message['host'], message['port'])
+            if 'encodings' in message:
+                self.peer_encodings[address] = tuple(encoding for encoding in protocol.ENCODINGS if encoding in message['encodings'])
+                if message.get('reply'):
+                    # Answer to our own NEW_PEER, the connection is already set up
+                    self.peers.add(address)
+                    self.notify('peers')
+                    return
+                # Tell the peer which encodings it can send us
+                self.send_to(message['host'], message['port'], {
+                    'type': 'NEW_PEER',
+                    'host': self.host,
+                    'port': self.port,
+                    'encodings': list(protocol.ENCODINGS),
+                    'reply': True
+                })
+            self.peers.add(address)
+            self.notify('peers')
             safe_print(f"Nuevo peer añadido: {message['host']}:{message['port']}")
-            self.send_chain(message['host'], message['port'])
+            self.request_headers(message['host'], message['port'])
             self.send_pending_transactions(message['host'], message['port'])
 
         elif message['type'] == 'GET_PEERS':
             self.send_peers(message['host'], message['port'])
 
         elif message['type'] == 'NEW_BLOCK':
-            new_block = Block.from_dict(message)
-            if new_block.hash == new_block.calculate_hash() and new_block.previous_hash == self.blockchain.get_latest_block().hash:
-                if self.blockchain.add_block(new_block.transactions):
-                    safe_print(f"Nuevo bloque añadido a la cadena: {new_block.hash}")
-                else:
-                    safe_print("Error al añadir el nuevo bloque a la cadena")
-            else:
+            if bytes.fromhex(message['hash']) in self.received_blocks:
+                return
+            new_block = message.get('block') or Block.from_dict(message)
+            tip = self.blockchain.get_latest_block().hash
+            result = self.blockchain.accept_block(new_block)
+            if result != 'invalid':
+                self.received_blocks.add(bytes.fromhex(new_block.hash))
+            if result == 'invalid':
                 safe_print("El bloque recibido es inválido")
+            elif result == 'orphan' and 'host' in message:
+                # We are missing blocks before this one, sync from the sender
+                self.request_headers(message['host'], message['port'])
+            elif result in ('added', 'reorg'):
+                safe_print(f"Nuevo bloque añadido a la cadena: {new_block.hash}" if result == 'added' else
+                           f"Reorganización hacia el bloque {new_block.hash}")
+                # Relaying costs our peers one validation, not a mining run
+                self.broadcast_block(new_block)
+            if self.blockchain.get_latest_block().hash != tip:
+                self.notify('chain', 'mempool')
         elif message['type'] == 'CHAIN':
+            # Peers that predate headers-first sync still send whole chains
             new_chain = [Block.from_dict(block) for block in message['chain']]
-            if self.blockchain.replace_chain(new_chain):
+            fork_point = self.blockchain.find_fork_point(new_chain)
+            if self.blockchain.replace_chain(fork_point, new_chain[fork_point:]):
+                self.notify('chain', 'mempool')
                 safe_print("Cadena reemplazada con la cadena recibida.")
+        elif message['type'] == 'GET_HEADERS':
+            self.send_to(message['host'], message['port'], {
+                'type': 'HEADERS',
+                'headers': self.blockchain.headers_after(message['locator'], ChainSync.MAX_HEADERS),
+                'host': self.host,
+                'port': self.port
+            })
+        elif message['type'] == 'HEADERS':
+            peer = (message['host'], message['port'])
+            self.send_sync_requests(self.sync.on_headers(peer, message['headers'], list(self.peers)))
+        elif message['type'] == 'GET_BLOCKS':
+            self.send_to(message['host'], message['port'], {
+                'type': 'BLOCKS',
+                'blocks': [block.to_dict() for block in self.blockchain.get_blocks_by_hash(message['hashes'])],
+                'host': self.host,
+                'port': self.port
+            })
+        elif message['type'] == 'BLOCKS':
+            requests, result = self.sync.on_blocks((message['host'], message['port']), message['blocks'])
+            self.send_sync_requests(requests)
+            if result and self.blockchain.replace_chain(*result):
+                self.notify('chain', 'mempool')
+                safe_print(f"Cadena sincronizada desde el bloque {result[0]} hasta el {len(self.blockchain.chain) - 1}")
         elif message['type'] == 'NEW_TRANSACTION':
-            transaction_data = json.dumps(message['transaction'])
-            if transaction_data not in self.received_transactions:
-                self.received_transactions.add(transaction_data)
-                transaction = Transaction.from_dict(message['transaction'])
-                if self.blockchain.add_transaction(transaction.sender, transaction.recipient, transaction.amount):
-                    self.broadcast_transaction(transaction)
+            transaction = Transaction.from_dict(message['transaction'])
+            if self.blockchain.accept_transaction(transaction):
+                self.notify('mempool')
+                self.broadcast_transaction(transaction)
         elif message['type'] == 'PENDING_TRANSACTIONS':
-            pending_transactions = [Transaction.from_dict(tx) for tx in message['transactions']]
-            self.blockchain.pending_transactions.extend(pending_transactions)
+            accepted = [self.blockchain.accept_transaction(Transaction.from_dict(tx)) for tx in message['transactions']]
+            if any(accepted):
+                self.notify('mempool')
+        elif message['type'] == 'GET_PROOF':
+            self.send_proof(message['host'], message['port'], message['tx_hash'])
+        elif message['type'] == 'PROOF':
+            if message['proof'] is None:
+                safe_print(f"El peer no encontró la transacción {message['tx_hash']}")
+            else:
+                try:
+                    transaction = Transaction.from_dict(message['proof']['transaction'])
+                    header = message['proof']['header']
+                    # Anyone can build a header around a made-up merkle root, so
+                    # the block must also be on our main chain
+                    valid = (transaction.hash() == message['tx_hash'] and Blockchain.verify_transaction_proof(transaction, message['proof'])
+                             and self.blockchain.index_of(header['hash']) == header['index'])
+                except (KeyError, TypeError, ValueError, AttributeError):
+                    valid = False
+                if valid:
+                    safe_print(f"Transacción {message['tx_hash']} incluida en el bloque {message['proof']['header']['hash']}")
+                else:
+                    safe_print(f"Prueba de inclusión inválida para la transacción {message['tx_hash']}")
+
+    def get_link(self, address):
+        link = self.links.get(address)
+        if link is None:
+            link = PeerLink(self, address)
+            self.links[address] = link
+        return link
+
+    def drop_peer(self, address, error):
+        self.peers.discard(address)
+        self.peer_encodings.pop(address, None)
+        self.notify('peers')
+        link = self.links.pop(address, None)
+        if link is not None:
+            link.close()
+        safe_print(f"Peer {address} no disponible, eliminado de la lista: {error}")
+
+    async def enqueue(self, address, frame):
+        return await self.get_link(address).put(frame)
+
+    async def broadcast_frame(self, frames):
+        # Every peer's queue is filled concurrently, a full queue only delays its own peer
+        await asyncio.gather(*(self.enqueue(peer, frame) for peer, frame in frames.items()))
 
-        self.message_received.emit(message)  # Emit the signal with the received message
+    def peer_frames(self, message):
+        # Frame for every peer, encoded once per distinct set of encodings
+        frames = {}
+        by_encodings = {}
+        for peer in list(self.peers):
+            encodings = self.peer_encodings.get(peer, ())
+            if encodings not in by_encodings:
+                by_encodings[encodings] = protocol.encode_frame(message, encodings)
+            frames[peer] = by_encodings[encodings]
+        return frames
+
+    def send_to(self, host, port, message):
+        frame = protocol.encode_frame(message, self.peer_encodings.get((host, port), ()))
+        return self.post(self.enqueue((host, port), frame))
+
+    async def open_peer(self, host, port):
+        link = self.get_link((host, port))
+        await link.connect()
+        return await link.put(protocol.encode_frame({
+            'type': 'NEW_PEER',
+            'host': self.host,
+            'port': self.port,
+            'encodings': list(protocol.ENCODINGS)
+        }))
 
     def connect_to_peer(self, host, port):
         if (host, port) not in self.peers:
             try:
-                client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                client.settimeout(5)  # Timeout de 5 segundos para evitar conexiones colgantes
-                client.connect((host, port))
-                self.send_message(client, {
-                    'type': 'NEW_PEER',
-                    'host': self.host,
-                    'port': self.port
-                })
-                self.peers.add((host, port))
-                safe_print(f"Conectado al peer: {host}:{port}")
-            except socket.timeout:
+                if self.call(self.open_peer(host, port)):
+                    self.peers.add((host, port))
+                    self.notify('peers')
+                    safe_print(f"Conectado al peer: {host}:{port}")
+                    self.on_chain(self.request_headers, host, port)
+            except asyncio.TimeoutError:
                 safe_print(f"Conexión a {host}:{port} agotada")
             except Exception as e:
                 safe_print(f"No se pudo conectar a {host}:{port}: {e}")
 
-    def send_message(self, client, message):
-        client.send(json.dumps(message).encode('utf-8'))
-
     def send_peers(self, host, port):
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.settimeout(5)
-        try:
-            client.connect((host, port))
-            self.send_message(client, {
-                'type': 'PEER_LIST',
-                'peers': list(self.peers)
-            })
-        except socket.timeout:
-            safe_print(f"Conexión a {host}:{port} agotada")
-        except Exception as e:
-            safe_print(f"No se pudieron enviar los peers a {host}:{port}: {e}")
-        finally:
-            client.close()
+        self.send_to(host, port, {
+            'type': 'PEER_LIST',
+            'peers': list(self.peers)
+        })
 
-    def broadcast_chain(self):
-        chain_data = {
-            'type': 'CHAIN',
-            'chain': [block.to_dict() for block in self.blockchain.chain]
-        }
-        self.broadcast(chain_data) 
-        
+    def send_proof(self, host, port, tx_hash):
+        self.send_to(host, port, {
+            'type': 'PROOF',
+            'tx_hash': tx_hash,
+            'proof': self.blockchain.get_transaction_proof(tx_hash)
+        })
 
-    def send_chain(self, host, port):
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.settimeout(5)
-        try:
-            client.connect((host, port))
-            chain_data = {
-                'type': 'CHAIN',
-                'chain': [block.to_dict() for block in self.blockchain.chain]
-            }
-            self.send_message(client, chain_data)
-        except socket.timeout:
-            safe_print(f"Conexión a {host}:{port} agotada")
-        except Exception as e:
-            safe_print(f"No se pudo enviar la cadena a {host}:{port}: {e}")
-        finally:
-            client.close()
+    def request_proof(self, host, port, tx_hash):
+        self.send_to(host, port, {
+            'type': 'GET_PROOF',
+            'tx_hash': tx_hash,
+            'host': self.host,
+            'port': self.port
+        })
+
+    def request_headers(self, host, port):
+        self.send_to(host, port, {
+            'type': 'GET_HEADERS',
+            'locator': self.blockchain.block_locator(),
+            'host': self.host,
+            'port': self.port
+        })
+
+    def send_sync_requests(self, requests):
+        for (host, port), message in requests:
+            message.update({'host': self.host, 'port': self.port})
+            self.send_to(host, port, message)
 
     def send_pending_transactions(self, host, port):
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.settimeout(5)
-        try:
-            client.connect((host, port))
-            pending_transactions_data = {
-                'type': 'PENDING_TRANSACTIONS',
-                'transactions': [tx.to_dict() for tx in self.blockchain.pending_transactions]
-            }
-            self.send_message(client, pending_transactions_data)
-        except socket.timeout:
-            safe_print(f"Conexión a {host}:{port} agotada")
-        except Exception as e:
-            safe_print(f"No se pudieron enviar las transacciones pendientes a {host}:{port}: {e}")
-        finally:
-            client.close()
+        pending_transactions_data = {
+            'type': 'PENDING_TRANSACTIONS',
+            'transactions': [tx.to_dict() for tx in self.blockchain.pending_transactions]
+        }
+        self.send_to(host, port, pending_transactions_data)
 
     def broadcast_block(self, block):
-        block_data = block.to_dict()
-        block_data['type'] = 'NEW_BLOCK'
+        self.received_blocks.add(bytes.fromhex(block.hash))
+        # The hash goes first, where receivers look for it before decoding
+        block_data = {'type': 'NEW_BLOCK', 'hash': block.hash}
+        block_data.update(block.to_dict())
+        block_data.update({'host': self.host, 'port': self.port})
         self.broadcast(block_data)
 
     def broadcast(self, message):
-        peers_copy = list(self.peers)
-        for peer in peers_copy:
-            try:
-                client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                client.settimeout(5)  # Timeout to avoid hanging connections
-                client.connect(peer)
-                self.send_message(client, message)
-                client.close()
-            except socket.timeout:
-                safe_print(f"Conexión a {peer} agotada")
-            except Exception as e:
-                self.peers.remove(peer)
-                safe_print(f"Peer {peer} no disponible, eliminado de la lista: {e}")
+        self.post(self.broadcast_frame(self.peer_frames(message)))
 
-    def broadcast_transaction(self, transaction):
-        transaction_data = {
+    def transaction_frames(self, transaction):
+        frames = self.peer_frames({
             'type': 'NEW_TRANSACTION',
             'transaction': transaction.to_dict()
-        }
-        self.broadcast(transaction_data)
+        })
+        # Our own transaction echoed back by a peer is dropped unread
+        for frame in set(frames.values()):
+            self.received_transactions.add(hashlib.sha256(frame[protocol.FRAME_HEADER.size:]).digest())
+        return frames
+
+    def broadcast_transaction(self, transaction):
+        self.post(self.broadcast_frame(self.transaction_frames(transaction)))
 
     def get_balance(self):
         return self.blockchain.get_balance(self.node_id)
-    
-    def start_mining(self):
-        new_block = self.blockchain.mine_pending_transactions()
+
+    def add_transaction(self, recipient, amount, fee=0):
+        def add():
+            transaction = self.blockchain.add_transaction(self.node_id, recipient, amount, self.private_key, fee)
+            if transaction:
+                self.notify('mempool')
+                self.broadcast_transaction(transaction)
+                return True
+            return False
+        return self.on_chain(add)
+
+    def mine(self):
+        # Runs on the mining thread. The block is built and appended on the
+        # chain thread, and mining stops early if a peer's block moves our tip.
+        template = self.on_chain(self.blockchain.pending_block, self.node_id)
+        if template is None:
+            return None
+        if not template.mine_block(self.blockchain.mining_workers, lambda: self.blockchain.published.tip_hash != template.previous_hash):
+            safe_print("Minado cancelado: llegó un bloque nuevo a la cadena")
+            return None
+        return self.on_chain(self.append_mined, template)
+
+    def append_mined(self, block):
+        new_block = self.blockchain.append_mined(block)
         if new_block:
-            self.broadcast_chain()  # Broadcast the entire chain after mining
-            self.broadcast_block(new_block)  # Broadcast the new block after mining
+            self.notify('chain', 'mempool')
+            self.broadcast_block(new_block)  # Peers that fall behind catch up through headers-first sync
+        return new_block
+
+    def start_mining(self):
+        return self.mining_executor.submit(self.mine).result()
 
 # Usage example
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        safe_print("Uso: python p2p.py <puerto>")
+    if len(sys.argv) not in (2, 3, 4):
+        safe_print("Uso: python p2p.py <puerto> [procesos_de_minado] [puerto_metricas]")
         sys.exit(1)
 
     my_port = int(sys.argv[1])
+    mining_workers = int(sys.argv[2]) if len(sys.argv) >= 3 else 1
+    if len(sys.argv) == 4:
+        metrics.serve(int(sys.argv[3]))
+        safe_print(f"Métricas en http://127.0.0.1:{sys.argv[3]}/metrics")
     all_ports = [5001, 5002, 5003, 5004]
     
     if my_port in all_ports:
         all_ports.remove(my_port)
     
-    node = Node("localhost", my_port)
+    node = Node("localhost", my_port, mining_workers=mining_workers)
     
     safe_print(f"Iniciando nodo en el puerto {my_port}")
     
-    node_thread = threading.Thread(target=node.start)
+    node_thread = threading.Thread(target=node.start, daemon=True)
     node_thread.start()
 
     for port in all_ports:
@@ -237,15 +638,15 @@ if __name__ == "__main__":
         while True:
             action = input("Ingrese 't' para añadir una transacción, 'm' para minar transacciones pendientes, o 'b' para verificar el saldo: ").strip().lower()
             if action == 't':
-                recipient = input("Ingrese el puerto del destinatario: ").strip()
+                recipient = input("Ingrese la dirección del destinatario: ").strip()
                 amount = float(input("Ingrese la cantidad: ").strip())
-                if node.blockchain.add_transaction(node.node_id, recipient, amount):
-                    transaction = Transaction(node.node_id, recipient, amount)
-                    node.broadcast_transaction(transaction)
+                fee = float(input("Ingrese la comisión (0 si no hay): ").strip() or 0)
+                node.add_transaction(recipient, amount, fee)
             elif action == 'm':
                 node.start_mining()  # Call the mining method which will also broadcast the block    
             elif action == 'b':
                 safe_print(f"Saldo actual: {node.get_balance()}")
     except KeyboardInterrupt:
         safe_print("Apagando nodo...")
-        sys.exit(0)
\ No newline at end of file
+        node.stop()
+        sys.exit(0)
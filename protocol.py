@@ -0,0 +1,324 @@
+import asyncio
+import datetime
+import json
+import struct
+import zlib
+
+import encoding
+
+# Every message travels as a frame: payload length (u32), message type (u8),
+# then the payload: the message without its 'type' key, as JSON or, for peers
+# that announced they read it, in the binary encoding below. The two high bits
+# of the type byte say whether the payload is binary and whether it is zlib
+# compressed, so peers that predate them only ever get plain JSON frames.
+MESSAGE_TYPES = [
+    'NEW_PEER',
+    'GET_PEERS',
+    'PEER_LIST',
+    'NEW_BLOCK',
+    'CHAIN',
+    'NEW_TRANSACTION',
+    'PENDING_TRANSACTIONS',
+    'GET_PROOF',
+    'PROOF',
+    'GET_HEADERS',
+    'HEADERS',
+    'GET_BLOCKS',
+    'BLOCKS',
+]
+TYPE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES, 1)}
+FRAME_HEADER = struct.Struct('!IB')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+BINARY_FLAG = 0x80
+COMPRESSED_FLAG = 0x40
+TYPE_MASK = 0x3f
+# Sent in NEW_PEER; a peer only gets what it announced
+ENCODINGS = ('binary', 'zlib')
+# Smaller payloads rarely shrink enough to pay for compressing them
+COMPRESS_THRESHOLD = 2048
+# Real messages nest a handful of levels; this keeps a crafted one from
+# exhausting the stack while it is decoded
+MAX_DEPTH = 32
+
+# Binary values: a tag byte, then the value. Integers are zigzag varints,
+# floats 8 bytes, lowercase hex strings travel as their bytes (a 64 digit hash
+# as exactly 32) and ISO timestamps as microseconds. Dictionary keys that
+# messages use all the time are a single varint.
+NONE, FALSE, TRUE, INT, FLOAT, STR, HASH, HEX, LIST, DICT, TIMESTAMP = range(11)
+KEYS = [
+    'host', 'port', 'hash', 'previous_hash', 'index', 'timestamp', 'nonce', 'version', 'target', 'merkle_root',
+    'transactions', 'transaction', 'sender', 'recipient', 'amount', 'fee', 'public_key', 'signature',
+    'blocks', 'headers', 'hashes', 'locator', 'peers', 'chain', 'tx_hash', 'proof', 'header', 'branch',
+    'position', 'block_index', 'encodings', 'reply',
+]
+KEY_CODES = {key: code for code, key in enumerate(KEYS, 1)}
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    return value // 2 if not value & 1 else -(value + 1) // 2
+
+
+def is_hex(text):
+    return len(text) % 2 == 0 and text != '' and HEX_DIGITS.issuperset(text)
+
+
+def encode_value(value, out, key=None):
+    if value is None:
+        out.append(NONE)
+    elif value is True or value is False:
+        out.append(TRUE if value else FALSE)
+    elif isinstance(value, int):
+        out.append(INT)
+        out += encoding.encode_varint(zigzag(value))
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += encoding.encode_amount(value)
+    elif isinstance(value, str):
+        if len(value) == 64 and is_hex(value):
+            out.append(HASH)
+            out += bytes.fromhex(value)
+        elif is_hex(value):
+            out.append(HEX)
+            out += encoding.encode_bytes(bytes.fromhex(value))
+        elif key == 'timestamp' and timestamp_round_trips(value):
+            out.append(TIMESTAMP)
+            out += encoding.encode_varint(zigzag(encoding.timestamp_to_micros(datetime.datetime.fromisoformat(value))))
+        else:
+            out.append(STR)
+            out += encoding.encode_str(value)
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        out += encoding.encode_varint(len(value))
+        for item in value:
+            encode_value(item, out)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        out += encoding.encode_varint(len(value))
+        for item_key, item in value.items():
+            code = KEY_CODES.get(item_key)
+            if code is None:
+                out.append(0)
+                out += encoding.encode_str(item_key)
+            else:
+                out += encoding.encode_varint(code)
+            encode_value(item, out, item_key)
+    else:
+        raise ProtocolError(f"Valor no codificable: {type(value).__name__}")
+
+
+def timestamp_round_trips(text):
+    try:
+        return datetime.datetime.fromisoformat(text).isoformat() == text
+    except ValueError:
+        return False
+
+
+def read_varint(buf, offset):
+    # Lengths, counts and key codes almost always fit in one byte
+    byte = buf[offset]
+    if byte < 0x80:
+        return byte, offset + 1
+    return encoding.decode_varint(buf, offset)
+
+
+def decode_value(buf, offset, depth=0):
+    tag = buf[offset]
+    offset += 1
+    if tag == STR:
+        length, offset = read_varint(buf, offset)
+        end = offset + length
+        if end > len(buf):
+            raise ProtocolError("Datos truncados")
+        return buf[offset:end].decode('utf-8'), end
+    if tag == HASH:
+        end = offset + 32
+        if end > len(buf):
+            raise ProtocolError("Datos truncados")
+        return buf[offset:end].hex(), end
+    if tag == HEX:
+        length, offset = read_varint(buf, offset)
+        end = offset + length
+        if end > len(buf):
+            raise ProtocolError("Datos truncados")
+        return buf[offset:end].hex(), end
+    if tag == INT:
+        value, offset = read_varint(buf, offset)
+        return unzigzag(value), offset
+    if tag == FLOAT:
+        return encoding.decode_amount(buf, offset)
+    if tag in (DICT, LIST) and depth >= MAX_DEPTH:
+        raise ProtocolError("Mensaje binario demasiado anidado")
+    if tag == DICT:
+        count, offset = read_varint(buf, offset)
+        value = {}
+        for _ in range(count):
+            code, offset = read_varint(buf, offset)
+            if code == 0:
+                key, offset = encoding.decode_str(buf, offset)
+            else:
+                key = KEYS[code - 1]
+            value[key], offset = decode_value(buf, offset, depth + 1)
+        return value, offset
+    if tag == LIST:
+        count, offset = read_varint(buf, offset)
+        value = []
+        for _ in range(count):
+            item, offset = decode_value(buf, offset, depth + 1)
+            value.append(item)
+        return value, offset
+    if tag == TIMESTAMP:
+        micros, offset = encoding.decode_varint(buf, offset)
+        return encoding.micros_to_timestamp(unzigzag(micros)).isoformat(), offset
+    if tag in (NONE, FALSE, TRUE):
+        return (None, False, True)[tag], offset
+    raise ProtocolError(f"Etiqueta binaria desconocida: {tag}")
+
+
+def encode_binary(body):
+    out = bytearray()
+    encode_value(body, out)
+    return bytes(out)
+
+
+def decode_binary(payload):
+    try:
+        value, offset = decode_value(payload, 0)
+    except (IndexError, KeyError, ValueError, UnicodeDecodeError, struct.error, OverflowError) as e:
+        raise ProtocolError(f"Mensaje binario inválido: {e}")
+    if offset != len(payload) or not isinstance(value, dict):
+        raise ProtocolError("Mensaje binario inválido")
+    return value
+
+
+def encode_frame(message, encodings=()):
+    # `encodings` are the ones the receiving peer announced, none for JSON.
+    # Small messages go binary. Large ones (chains, block batches, pending
+    # transactions) go as compressed JSON: zlib takes out most of what the
+    # binary encoding saves on hex hashes, and the C JSON parser decodes them
+    # several times faster than the binary decoder can.
+    body = {key: value for key, value in message.items() if key != 'type'}
+    flags = 0
+    payload = json.dumps(body).encode('utf-8')
+    if len(payload) >= COMPRESS_THRESHOLD and 'zlib' in encodings:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= COMPRESSED_FLAG
+    elif 'binary' in encodings:
+        payload = encode_binary(body)
+        flags |= BINARY_FLAG
+    return FRAME_HEADER.pack(len(payload), TYPE_CODES[message['type']] | flags) + payload
+
+
+def decompress(payload):
+    # Bounded like any frame, so a small payload cannot inflate without limit
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise ProtocolError(f"Mensaje comprimido inválido: {e}")
+    if decompressor.unconsumed_tail:
+        raise ProtocolError("Mensaje comprimido demasiado grande")
+    return data
+
+
+def peek_hash(type_code, payload):
+    # The 'hash' field of a frame whose body starts with it, as bytes, read
+    # without decoding the rest; None for any other frame. A compressed frame
+    # only has its first bytes inflated.
+    if type_code & COMPRESSED_FLAG:
+        try:
+            payload = zlib.decompressobj().decompress(payload, 128)
+        except zlib.error:
+            return None
+    if type_code & BINARY_FLAG:
+        # Dict tag, field count, key code of 'hash', hash tag, 32 bytes
+        try:
+            _, offset = read_varint(payload, 1)
+        except (IndexError, ValueError):
+            return None
+        if payload[:1] != bytes([DICT]) or payload[offset:offset + 2] != bytes([KEY_CODES['hash'], HASH]) or len(payload) < offset + 34:
+            return None
+        return bytes(payload[offset + 2:offset + 34])
+    prefix = b'{"hash": "'
+    if not payload.startswith(prefix):
+        return None
+    try:
+        return bytes.fromhex(payload[len(prefix):len(prefix) + 64].decode('ascii'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+def decode_frame(type_code, payload):
+    flags = type_code & ~TYPE_MASK
+    type_code &= TYPE_MASK
+    if not 1 <= type_code <= len(MESSAGE_TYPES):
+        raise ProtocolError(f"Tipo de mensaje desconocido: {type_code}")
+    if flags & COMPRESSED_FLAG:
+        payload = decompress(payload)
+    if flags & BINARY_FLAG:
+        message = decode_binary(payload)
+    else:
+        try:
+            message = json.loads(payload)
+        except (ValueError, RecursionError) as e:
+            raise ProtocolError(f"Mensaje JSON inválido: {e}")
+        if not isinstance(message, dict):
+            raise ProtocolError("Mensaje JSON inválido")
+    message['type'] = MESSAGE_TYPES[type_code - 1]
+    return message
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(min(remaining, 65536))
+        if not chunk:
+            if remaining == size:
+                return None
+            raise ProtocolError("Conexión cerrada a mitad de un mensaje")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_frame(sock):
+    # Returns (type_code, payload), or None when the peer closed the connection
+    header = recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    length, type_code = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Mensaje demasiado grande: {length} bytes")
+    payload = recv_exactly(sock, length) if length else b''
+    if payload is None:
+        raise ProtocolError("Conexión cerrada a mitad de un mensaje")
+    return type_code, payload
+
+
+async def read_frame_async(reader):
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError("Conexión cerrada a mitad de un mensaje")
+    length, type_code = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Mensaje demasiado grande: {length} bytes")
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("Conexión cerrada a mitad de un mensaje")
+    return type_code, payload
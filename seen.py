@@ -0,0 +1,42 @@
+import collections
+import threading
+import time
+
+
+class SeenCache:
+    # Set of 32-byte digests for gossip deduplication. Entries are forgotten
+    # after `ttl` seconds, and the oldest ones go first once `max_entries` is
+    # reached, so memory stays constant however long the node runs.
+
+    def __init__(self, max_entries=100000, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        # Shared by the event loop and the chain thread
+        self.lock = threading.Lock()
+
+    def expire(self, now):
+        while self.entries:
+            digest, added = next(iter(self.entries.items()))
+            if now - added <= self.ttl and len(self.entries) <= self.max_entries:
+                break
+            self.entries.popitem(last=False)
+
+    def __contains__(self, digest):
+        with self.lock:
+            self.expire(time.monotonic())
+            return digest in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, digest):
+        # Returns False when the digest was already there
+        with self.lock:
+            now = time.monotonic()
+            self.expire(now)
+            if digest in self.entries:
+                return False
+            self.entries[digest] = now
+            self.expire(now)
+            return True
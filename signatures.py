@@ -0,0 +1,116 @@
+import collections
+import concurrent.futures
+import hashlib
+import os
+import threading
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+
+# Transactions are signed with Ed25519. Keys and signatures travel as hex strings.
+RAW = serialization.Encoding.Raw
+
+
+def generate_key():
+    return Ed25519PrivateKey.generate()
+
+
+def load_or_create_key(path):
+    # The node's private key is kept as 32 raw bytes in hex next to its database
+    if os.path.exists(path):
+        with open(path) as f:
+            return Ed25519PrivateKey.from_private_bytes(bytes.fromhex(f.read().strip()))
+    key = generate_key()
+    raw = key.private_bytes(RAW, serialization.PrivateFormat.Raw, serialization.NoEncryption())
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        f.write(raw.hex())
+    return key
+
+
+def public_key_hex(private_key):
+    return private_key.public_key().public_bytes(RAW, serialization.PublicFormat.Raw).hex()
+
+
+def address(public_key):
+    # An account is named after the key that owns it: the first 20 bytes of
+    # the SHA-256 of the raw public key, in hex. Only that key can spend from it.
+    return hashlib.sha256(bytes.fromhex(public_key)).hexdigest()[:40]
+
+
+def owns(public_key, account):
+    try:
+        return address(public_key) == account
+    except (ValueError, TypeError):
+        return False
+
+
+def sign(private_key, message):
+    return private_key.sign(message).hex()
+
+
+def verify(public_key, signature, message):
+    try:
+        Ed25519PublicKey.from_public_bytes(bytes.fromhex(public_key)).verify(bytes.fromhex(signature), message)
+        return True
+    except (InvalidSignature, ValueError):
+        return False
+
+
+def verify_chunk(items):
+    return [verify(public_key, signature, message) for public_key, signature, message in items]
+
+
+class SignatureVerifier:
+    # Verifies batches of (txid, public_key, signature, message). Results are
+    # cached by transaction id, so a transaction checked when it entered the
+    # mempool is not checked again when its block arrives. Large batches are
+    # split over a process pool.
+    MIN_PARALLEL_BATCH = 64
+
+    def __init__(self, workers=None, cache_size=100000):
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def cached(self, txid):
+        with self.lock:
+            result = self.cache.get(txid)
+            if result is not None:
+                self.cache.move_to_end(txid)
+            return result
+
+    def remember(self, txid, result):
+        with self.lock:
+            self.cache[txid] = result
+            self.cache.move_to_end(txid)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def verify_batch(self, items):
+        results = [self.cached(txid) for txid, _, _, _ in items]
+        pending = [(position, item) for position, item in enumerate(items) if results[position] is None]
+        if not pending:
+            return results
+
+        signed = [(public_key, signature, message) for _, (_, public_key, signature, message) in pending]
+        if self.workers <= 1 or len(signed) < self.MIN_PARALLEL_BATCH:
+            verified = verify_chunk(signed)
+        else:
+            if self.pool is None:
+                self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            size = -(-len(signed) // self.workers)
+            chunks = [signed[start:start + size] for start in range(0, len(signed), size)]
+            verified = [result for chunk in self.pool.map(verify_chunk, chunks) for result in chunk]
+
+        for (position, (txid, _, _, _)), result in zip(pending, verified):
+            results[position] = result
+            self.remember(txid, result)
+        return results
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
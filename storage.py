@@ -0,0 +1,137 @@
+import collections
+import json
+import sqlite3
+
+import encoding
+
+BLOCK_COLUMNS = 'block_index, timestamp, transactions, previous_hash, nonce, hash, version, merkle_root, target'
+
+# Statements are kept as module constants so every call reuses the connection's
+# prepared statement cache.
+INSERT_BLOCK = f'INSERT INTO blocks ({BLOCK_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+INSERT_BLOCK_IF_NEW = f'INSERT OR IGNORE INTO blocks ({BLOCK_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+SELECT_BALANCE = 'SELECT amount, nonce FROM balances WHERE account = ?'
+UPSERT_BALANCE = 'INSERT OR REPLACE INTO balances (account, amount, nonce) VALUES (?, ?, ?)'
+INSERT_UNDO = 'INSERT INTO balance_undo (block_index, account, previous_amount, previous_nonce) VALUES (?, ?, ?, ?)'
+INSERT_TX_INDEX = 'INSERT OR IGNORE INTO tx_index (tx_hash, block_index, position) VALUES (?, ?, ?)'
+INSERT_ADDRESS_TX = 'INSERT OR IGNORE INTO address_tx (account, block_index, position) VALUES (?, ?, ?)'
+INSERT_CHAIN_WORK = 'INSERT OR REPLACE INTO chain_work (block_index, work) VALUES (?, ?)'
+SELECT_CHAIN_WORK = 'SELECT work FROM chain_work WHERE block_index = ?'
+
+# OFF never fsyncs, NORMAL fsyncs at WAL checkpoints (a power loss can drop the
+# last commits but never corrupts the file), FULL and EXTRA fsync every commit.
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+def connect(db_path, synchronous='NORMAL'):
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Modo synchronous inválido: {synchronous}")
+    conn = sqlite3.connect(db_path, cached_statements=256)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA synchronous = {synchronous}')
+    return conn
+
+
+def block_target(block):
+    return None if block.target is None else encoding.encode_target(block.target).hex()
+
+
+def block_row(block):
+    return (
+        block.index,
+        block.timestamp.isoformat(),
+        json.dumps([tx.to_row() for tx in block.transactions], separators=(',', ':')),
+        block.previous_hash,
+        block.nonce,
+        block.hash,
+        block.version,
+        None,
+        block_target(block)
+    )
+
+
+def header_row(block):
+    # Blocks below a snapshot are kept as headers: no transactions, and the
+    # Merkle root their hash commits to stored instead
+    return (
+        block.index,
+        block.timestamp.isoformat(),
+        None,
+        block.previous_hash,
+        block.nonce,
+        block.hash,
+        block.version,
+        block.merkle_root().hex(),
+        block_target(block)
+    )
+
+
+class ChainView:
+    # Read-only sequence over the blocks table. Only a bounded LRU of decoded
+    # blocks is kept in memory, everything else is read from SQLite on demand.
+
+    def __init__(self, conn, decode_row, cache_size=256, page_size=500):
+        self.conn = conn
+        self.decode_row = decode_row
+        self.cache_size = cache_size
+        self.page_size = page_size
+        self.cache = collections.OrderedDict()
+        self.reload()
+
+    def reload(self):
+        row = self.conn.execute('SELECT MAX(block_index) FROM blocks').fetchone()
+        self.length = 0 if row[0] is None else row[0] + 1
+        self.cache.clear()
+
+    def remember(self, block):
+        self.cache[block.index] = block
+        self.cache.move_to_end(block.index)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def append(self, block):
+        if block.index != self.length:
+            raise ValueError(f"Se esperaba el bloque {self.length}, se recibió el {block.index}")
+        self.length += 1
+        self.remember(block)
+
+    def truncate(self, length):
+        for index in [index for index in self.cache if index >= length]:
+            del self.cache[index]
+        self.length = min(self.length, length)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("Índice de bloque fuera de rango")
+        block = self.cache.get(index)
+        if block is None:
+            row = self.conn.execute(f'SELECT {BLOCK_COLUMNS} FROM blocks WHERE block_index = ?', (index,)).fetchone()
+            block = self.decode_row(row)
+        self.remember(block)
+        return block
+
+    def iter_from(self, start=0, stop=None, reverse=False):
+        # Streams blocks page by page without filling the cache
+        stop = self.length if stop is None else min(stop, self.length)
+        pages = range(start, stop, self.page_size)
+        for page_start in (reversed(pages) if reverse else pages):
+            page_stop = min(page_start + self.page_size, stop)
+            rows = self.conn.execute(
+                f'SELECT {BLOCK_COLUMNS} FROM blocks WHERE block_index >= ? AND block_index < ? ORDER BY block_index {"DESC" if reverse else "ASC"}',
+                (page_start, page_stop)
+            ).fetchall()
+            for row in rows:
+                yield self.cache.get(row[0]) or self.decode_row(row)
+
+    def __iter__(self):
+        return self.iter_from()
+
+    def __reversed__(self):
+        return self.iter_from(reverse=True)
@@ -0,0 +1,127 @@
+import collections
+import time
+
+from blockchain import Block, LEGACY_BLOCK_VERSION, TARGET_BLOCK_VERSION
+
+
+class SyncSession:
+    def __init__(self, peer, fork_point):
+        self.peer = peer
+        self.fork_point = fork_point
+        self.headers = []
+        self.bodies = {}
+        self.requested = {}
+        # Requests are answered in order on each peer's connection, so the
+        # oldest outstanding range of a peer is the one its next BLOCKS answers
+        self.outstanding = collections.defaultdict(collections.deque)
+        self.updated = time.monotonic()
+
+
+class ChainSync:
+    # Headers-first sync: headers are downloaded from one peer starting at a
+    # block locator, then block bodies are fetched in ranges spread over every
+    # known peer. Only the suffix after the fork point is ever transferred.
+    MAX_HEADERS = 2000
+    BLOCKS_PER_REQUEST = 100
+    SESSION_TIMEOUT = 30
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.session = None
+
+    def busy_with_other_peer(self, peer):
+        if self.session is None or self.session.peer == peer:
+            return False
+        if time.monotonic() - self.session.updated > self.SESSION_TIMEOUT:
+            self.session = None
+            return False
+        return True
+
+    def start_session(self, peer, first_header):
+        if first_header['index'] == 0:
+            return SyncSession(peer, 0)
+        parent_index = self.blockchain.index_of(first_header['previous_hash'])
+        if parent_index is None:
+            return None
+        return SyncSession(peer, parent_index + 1)
+
+    def on_headers(self, peer, headers, peers):
+        # Returns the requests to send next as a list of (peer, message) pairs
+        if not headers or self.busy_with_other_peer(peer):
+            return []
+        session = self.session
+        if session is None:
+            session = self.start_session(peer, headers[0])
+            if session is None:
+                return []
+        previous = session.headers[-1] if session.headers else None
+        for header in headers:
+            if previous is not None and (header['previous_hash'] != previous['hash'] or header['index'] != previous['index'] + 1):
+                self.session = None
+                return []
+            # Headers without a target have no proof of work to check, and a
+            # branch we do not have yet must not contain any
+            if header['index'] > 0 and header.get('version', LEGACY_BLOCK_VERSION) < TARGET_BLOCK_VERSION:
+                self.session = None
+                return []
+            if not Block.verify_header(header):
+                self.session = None
+                return []
+            previous = header
+        if session.headers == [] and headers[0]['index'] != session.fork_point:
+            return []
+        session.headers.extend(headers)
+        session.updated = time.monotonic()
+        self.session = session
+
+        if len(headers) == self.MAX_HEADERS:
+            return [(peer, {'type': 'GET_HEADERS', 'locator': [headers[-1]['hash']]})]
+        # Bodies are only worth downloading for a branch with more work than ours
+        branch_work = self.blockchain.work_before(session.fork_point) + sum(Block.header_work(header) for header in session.headers)
+        if branch_work <= self.blockchain.chain_work():
+            self.session = None
+            return []
+        return self.plan_requests([header['hash'] for header in session.headers], [peer] + [p for p in peers if p != peer])
+
+    def plan_requests(self, hashes, peers):
+        # Consecutive ranges of block hashes assigned round-robin to the peers
+        requests = []
+        for number, start in enumerate(range(0, len(hashes), self.BLOCKS_PER_REQUEST)):
+            chunk = hashes[start:start + self.BLOCKS_PER_REQUEST]
+            peer = peers[number % len(peers)]
+            requests.append(self.request_blocks(peer, chunk))
+        return requests
+
+    def request_blocks(self, peer, hashes):
+        for block_hash in hashes:
+            self.session.requested[block_hash] = peer
+        self.session.outstanding[peer].append(hashes)
+        return peer, {'type': 'GET_BLOCKS', 'hashes': hashes}
+
+    def on_blocks(self, peer, blocks):
+        # `blocks` are decoded and their hashes already checked. Returns
+        # (requests, result) where result is (fork_point, suffix) once every
+        # body of the session has arrived.
+        session = self.session
+        if session is None or not session.outstanding[peer]:
+            return [], None
+        expected = session.outstanding[peer].popleft()
+        for block in blocks:
+            if session.requested.get(block.hash) != peer:
+                continue
+            session.bodies[block.hash] = block
+            del session.requested[block.hash]
+        session.updated = time.monotonic()
+
+        # Anything this peer did not have is asked again from the peer that sent the headers
+        missing = [block_hash for block_hash in expected if block_hash not in session.bodies]
+        if missing and peer != session.peer:
+            return [self.request_blocks(session.peer, missing)], None
+        if missing:
+            self.session = None
+            return [], None
+        if session.requested:
+            return [], None
+
+        self.session = None
+        return [], (session.fork_point, [session.bodies[header['hash']] for header in session.headers])
@@ -1,10 +1,10 @@
 import sys
 import threading
 from p2p import Node  # Import the Node class
-from PyQt6.QtCore import QSize, Qt, QObject, pyqtSignal
+from PyQt6.QtCore import QSize, Qt, QObject, QTimer, pyqtSignal
 from PyQt6.QtGui import QCloseEvent
 from PyQt6.QtWidgets import (
-    QApplication, QVBoxLayout, QHBoxLayout, QGridLayout, QLabel,
+    QApplication, QVBoxLayout, QHBoxLayout, QGridLayout, QLabel, QListWidget,
     QPushButton, QWidget, QMainWindow, QSizePolicy, QMessageBox, QLineEdit
 )
 
@@ -17,43 +17,130 @@ class EnterPortDialog(QMessageBox):
         self.text_input = QLineEdit(self)
         self.text_input.setPlaceholderText("5500")
         self.layout().addWidget(self.text_input, 1, 0, 1, 2)
-        
+
         self.setStandardButtons(QMessageBox.StandardButton.Ok | QMessageBox.StandardButton.Cancel)
         self.exec()
 
+class NodeBridge(QObject):
+    # Runs the node on its own threads and carries its changes to the Qt thread.
+    # Node threads only mark what changed; a burst of changes becomes one read
+    # of the node state at most every UPDATE_INTERVAL_MS, done on the chain
+    # thread, and one `updated` signal with the result.
+    UPDATE_INTERVAL_MS = 250
+    KINDS = ('peers', 'mempool', 'chain')
+
+    ready = pyqtSignal()
+    failed = pyqtSignal(str)
+    stopped = pyqtSignal()
+    updated = pyqtSignal(object)
+    mining_finished = pyqtSignal(bool)
+    woken = pyqtSignal()
+    collected = pyqtSignal(object)
+
+    def __init__(self, host, port):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.node = None
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.collecting = False
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.UPDATE_INTERVAL_MS)
+        self.timer.timeout.connect(self.collect)
+        # Emitted from node threads, delivered on the Qt thread
+        self.woken.connect(self.schedule)
+        self.collected.connect(self.on_collected)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        # Opening the database can take a while, so the node is created here too
+        try:
+            self.node = Node(self.host, self.port)
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.node.subscribe(self.on_node_event)
+        self.node.start()
+        self.stopped.emit()
+
+    def stop(self):
+        if self.node is not None:
+            self.node.stop()
+
+    def on_node_event(self, kind):
+        if kind == 'started':
+            self.ready.emit()
+            kinds = self.KINDS
+        else:
+            kinds = (kind,)
+        with self.lock:
+            wake = not self.dirty
+            self.dirty.update(kinds)
+        # Only the first change of a burst crosses to the Qt thread
+        if wake:
+            self.woken.emit()
+
+    def schedule(self):
+        if not self.collecting and not self.timer.isActive():
+            self.timer.start()
+
+    def collect(self):
+        with self.lock:
+            kinds, self.dirty = self.dirty, set()
+        if not kinds:
+            return
+        self.collecting = True
+        future = self.node.chain_executor.submit(self.node.status, kinds)
+        future.add_done_callback(lambda future: self.collected.emit({} if future.exception() else future.result()))
+
+    def on_collected(self, status):
+        self.collecting = False
+        if status:
+            self.updated.emit(status)
+        with self.lock:
+            pending = bool(self.dirty)
+        if pending:
+            self.schedule()
+
+    def mine(self):
+        # Mining runs on its own thread; the new tip arrives as an update
+        future = self.node.mining_executor.submit(self.node.mine)
+        future.add_done_callback(lambda future: self.mining_finished.emit(not future.exception() and bool(future.result())))
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
 
-        self.label = QLabel("Messages will appear here", self)
+        self.label = QLabel("Los mensajes del nodo aparecerán aquí", self)
         self.label.setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
 
         # Get the port from the user
         port_dialog = EnterPortDialog()
         self.port = 5500
-        
+
         print("Waiting dialog")
         if(port_dialog.result() == QMessageBox.StandardButton.Ok):
             self.port = int(port_dialog.text_input.text())
         else:
             sys.exit(1)
 
-        # Initialize the node
-        print("Initializing node")
-        self.initialize_node()
-
         self.setWindowTitle("Blockchain from scratch")
         self.setFixedSize(QSize(1280, 720))
 
         main_layout = QVBoxLayout()
         main_layout.addWidget(self.label)
         # Navbar
-        navbar = Navbar(self.node)
+        self.bridge = NodeBridge("localhost", self.port)
+        navbar = Navbar(self.port)
         main_layout.addWidget(navbar)
 
         # Main Content Area
         main_content = QHBoxLayout()
-        left_panel = LeftPanel()
+        left_panel = LeftPanel(self.bridge)
         right_panel = ConnectedNodes()
 
         main_content.setSpacing(40)
@@ -67,67 +154,71 @@ class MainWindow(QMainWindow):
         container.setLayout(main_layout)
         self.setCentralWidget(container)
 
-       
-        # Setup UI components
-        # self.setup_ui()
-
-    def initialize_node(self):
-        # Initialize the Node
-        print(self.port)
-        self.node = Node("localhost", self.port)
-        self.node.message_received.connect(self.on_message_received)  # Connect the signal to the slot
+        self.bridge.updated.connect(navbar.update_status)
+        self.bridge.updated.connect(left_panel.update_status)
+        self.bridge.updated.connect(right_panel.update_status)
+        self.bridge.ready.connect(self.on_node_ready)
+        self.bridge.failed.connect(self.on_node_failed)
+        self.bridge.stopped.connect(lambda: self.label.setText("Nodo detenido"))
 
-        self.node_thread = threading.Thread(target=self.node.start)
-        self.node_thread.start()
+        # The node starts in the background, the window shows up right away
+        print("Initializing node")
+        self.label.setText(f"Iniciando nodo en el puerto {self.port}...")
+        self.bridge.start()
 
-        # Wait for the node to start running
-        while not self.node.running:
-            pass  # Busy-wait until the node is running
+    def on_node_ready(self):
+        self.label.setText(f"Nodo escuchando en localhost:{self.port}")
 
-        if(self.node.running):
-            print("Node is running now")
+    def on_node_failed(self, error):
+        self.label.setText(f"No se pudo iniciar el nodo: {error}")
 
-        print(self.node.get_balance())
-        
-    def on_message_received(self, message):
-        self.label.setText(message)
+    def closeEvent(self, event: QCloseEvent):
+        self.bridge.stop()
+        super().closeEvent(event)
 
 
 class Navbar(QWidget):
-    def __init__(self, node: Node):
+    def __init__(self, port):
         super().__init__()
 
-        self.node = node
-
-        self.setFixedHeight(80) 
+        self.setFixedHeight(80)
         self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
         self.setStyleSheet("font-size: 20px; border-radius: 10px; background-color: #333; color: white; padding: 10px;")
 
         layout = QHBoxLayout()
 
-        port = node.port
-        balance = node.get_balance()
-
-        label1 = QLabel("Puerto del nodo: " + str(node.port))
-        label2 = QLabel("Monedas: " + str(balance))
+        label1 = QLabel("Puerto del nodo: " + str(port))
+        self.tip_label = QLabel("Bloque: -")
+        self.balance_label = QLabel("Monedas: -")
 
         layout.addWidget(label1)
         layout.addStretch(1)
-        layout.addWidget(label2)
+        layout.addWidget(self.tip_label)
+        layout.addStretch(1)
+        layout.addWidget(self.balance_label)
 
         self.setLayout(layout)
 
+    def update_status(self, status):
+        if 'chain' in status:
+            chain = status['chain']
+            self.tip_label.setText(f"Bloque: #{chain['height']} {chain['hash'][:12]}")
+            self.balance_label.setText("Monedas: " + str(chain['balance']))
+
 
 class LeftPanel(QVBoxLayout):
-    def __init__(self):
+    def __init__(self, bridge):
         super().__init__()
         # Actions Panel
         actions = Actions()
         self.addWidget(actions)
 
         # Transactions to Mine Panel
-        transactions = PendingMine()
-        self.addWidget(transactions)
+        self.transactions = PendingMine(bridge)
+        self.addWidget(self.transactions)
+
+    def update_status(self, status):
+        self.transactions.update_status(status)
 
 class Actions(QWidget):
     def __init__(self):
@@ -138,16 +229,39 @@ class Actions(QWidget):
         self.setLayout(layout)
 
 class PendingMine(QWidget):
-    def __init__(self):
+    def __init__(self, bridge):
         super().__init__()
+        self.bridge = bridge
         layout = QGridLayout()
         self.setStyleSheet("padding: 20px;")
-        # Adding "Minar" buttons in a grid
-        for i in range(2):
-            for j in range(3):
-                layout.addWidget(QPushButton("Minar"), i, j)
+        self.summary = QLabel("Transacciones pendientes: -")
+        self.transactions = QListWidget()
+        self.mine_button = QPushButton("Minar")
+        self.mine_button.setEnabled(False)
+        self.mine_button.clicked.connect(self.mine)
+        bridge.ready.connect(lambda: self.mine_button.setEnabled(True))
+        bridge.mining_finished.connect(self.on_mining_finished)
+        layout.addWidget(self.summary, 0, 0)
+        layout.addWidget(self.mine_button, 0, 1)
+        layout.addWidget(self.transactions, 1, 0, 1, 2)
         self.setLayout(layout)
 
+    def mine(self):
+        self.mine_button.setEnabled(False)
+        self.mine_button.setText("Minando...")
+        self.bridge.mine()
+
+    def on_mining_finished(self, mined):
+        self.mine_button.setEnabled(True)
+        self.mine_button.setText("Minar" if mined else "Minar (no hay transacciones)")
+
+    def update_status(self, status):
+        if 'mempool' in status:
+            mempool = status['mempool']
+            self.summary.setText(f"Transacciones pendientes: {mempool['transactions']} ({mempool['bytes']} bytes)")
+            self.transactions.clear()
+            self.transactions.addItems([f"{tx['sender']} -> {tx['recipient']}: {tx['amount']} (comisión {tx.get('fee', 0)})" for tx in mempool['next']])
+
 class ConnectedNodes(QWidget):
     def __init__(self):
         super().__init__()
@@ -156,14 +270,19 @@ class ConnectedNodes(QWidget):
         label = QLabel("Nodos conectados")
         label.setStyleSheet("font-size: 24px; font-weight: 600; margin-left: 0; margin-bottom: 20px; background-color: #333; padding: 10px; border-radius: 10px;")
         layout.addWidget(label)
-        
-        for i in range(3):
-            newLabel = QLabel("Node - Port " + str(i+1))
-            newLabel.setStyleSheet("font-size: 16px")
-            layout.addWidget(newLabel)
+
+        self.peers = QListWidget()
+        self.peers.setStyleSheet("font-size: 16px")
+        layout.addWidget(self.peers)
         self.setLayout(layout)
 
-app = QApplication(sys.argv)
-window = MainWindow()
-window.show()
-app.exec()
+    def update_status(self, status):
+        if 'peers' in status:
+            self.peers.clear()
+            self.peers.addItems([f"{host} - Puerto {port}" for host, port in status['peers']])
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.show()
+    app.exec()